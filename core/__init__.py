@@ -1,2 +1,11 @@
-from core.instruments import QuantifiManager, TunicsManager, PowerMeterManager
-from core.control import ExperimentalSetUp
\ No newline at end of file
+# The instruments and set up are imported on first use so that e.g. "import core.analysis" doesn't load pyvisa, and
+# "from core import QuantifiManager" doesn't load the analysis libraries
+_lazy = {"QuantifiManager": "core.instruments", "TunicsManager": "core.instruments",
+         "PowerMeterManager": "core.instruments", "ExperimentalSetUp": "core.control"}
+
+
+def __getattr__(name):
+    if name in _lazy:
+        import importlib
+        return getattr(importlib.import_module(_lazy[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
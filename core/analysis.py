@@ -1,6 +1,11 @@
 """This file is for reading the data files into data structures and plotting them out"""
 # %%
+import json
+import multiprocessing
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor
 import numpy as np
+import matplotlib.pyplot as plt
 import seaborn as sns
 import pandas as pd
 from pathlib import Path
@@ -8,8 +13,7 @@ from scipy.signal import find_peaks
 
 from typing import Union
 
-root = Path(__file__).parents[1]
-data_directory = root/"Data"
+from core.utils import root, data_directory, parse_sweep_filename, convert_sweep_file
 
 
 def FSR_resonance(r: float, laser_wavelength: float = 1550, n: float = 3.48):
@@ -78,19 +82,182 @@ def get_DWDM_wavelengths(channels: int = 32):
     return wavelengths
 
 
-def plot_sweep(fname: str, title: str = "", save: bool = True):
+def load_sweep(fname: str):
     """
-    Function to plot the laser sweeps. Get graph of mean power against wavelength
+    Load a sweep saved as text or .npy into a DataFrame with the wavelength as the index and a column per repetition.
+    .npy files are memory-mapped rather than read into memory.
     """
     path = data_directory/fname
-    save_path = data_directory/(fname.split('.')[0]+".png")
+    if path.suffix == ".npy":
+        data = np.load(path, mmap_mode="r")
+        columns = [f"power_reading_{j}_dbm " for j in range(data.shape[1] - 1)]
+        return pd.DataFrame(data[:, 1:], index=pd.Index(data[:, 0], name="wavelength_nm "), columns=columns)
     # sets the wavelength_nm column as index
-    data = pd.read_csv(path, index_col=0)
+    return pd.read_csv(path, index_col=0)
+
+
+# Kinds of sweep whose rows aren't in order of wavelength
+UNSORTED_KINDS = ("resonance_finding", "adaptive_sweep")
+
+
+class Sweep:
+    """
+    A sweep file opened lazily. Nothing is read until the data is used and .npy files are memory-mapped, so only the
+    pages covering the requested wavelengths are read from disk. Text files are converted to .npy alongside the
+    original the first time they are opened.
 
-    data["mean_dbm"] = data.mean(axis=1)
-    data["variance"] = data.var(axis=1)
-    data["std"] = np.sqrt(data["variance"])
-    data["Wavelength(nm)"] = data.index
+    Arguments:
+    path: path to the sweep file, absolute or relative to data_directory
+    """
+
+    def __init__(self, path):
+        path = Path(path)
+        self.path = path if path.is_absolute() else data_directory/path
+        self._data = None
+        self._sorted = None
+
+    @property
+    def metadata(self):
+        metadata_path = self.path.with_suffix(".json")
+        if metadata_path.exists():
+            with open(metadata_path) as f:
+                return json.load(f)
+        return parse_sweep_filename(self.path.name) or {}
+
+    @property
+    def data(self):
+        """ Memory-mapped array of dim((steps, reps+1)) with the wavelength in the first column """
+        if self._data is None:
+            if self.path.suffix != ".npy":
+                npy_path = self.path.with_suffix(".npy")
+                self.path = npy_path if npy_path.exists() else convert_sweep_file(self.path)
+            self._data = np.load(self.path, mmap_mode="r")
+        return self._data
+
+    @property
+    def wavelengths(self):
+        return self.data[:, 0]
+
+    @property
+    def readings(self):
+        return self.data[:, 1:]
+
+    def __len__(self):
+        return len(self.data)
+
+    def window(self, wavelength_start: float, wavelength_end: float):
+        """ Rows with wavelength_start <= wavelength <= wavelength_end. For sorted sweeps this is a binary search and
+        returns a view of the memory-map, so only the rows in the window are read """
+        if self._sorted is None:
+            kind = self.metadata.get("kind")
+            # Only a file of unknown kind has to be read through to tell
+            self._sorted = kind not in UNSORTED_KINDS if kind is not None else \
+                bool(np.all(np.diff(self.wavelengths) >= 0))
+        if self._sorted:
+            start = np.searchsorted(self.wavelengths, wavelength_start, side="left")
+            end = np.searchsorted(self.wavelengths, wavelength_end, side="right")
+            return self.data[start:end]
+        # resonance_finding files are a series of windows and adaptive_sweep files have the refined points after
+        # the coarse ones, so they have to be masked instead
+        mask = (self.wavelengths >= wavelength_start) & (self.wavelengths <= wavelength_end)
+        return self.data[mask]
+
+    def mean_power(self, wavelength_start: float = -np.inf, wavelength_end: float = np.inf):
+        """ Wavelengths and mean power over the repetitions in a wavelength window """
+        rows = self.window(wavelength_start, wavelength_end)
+        return rows[:, 0], rows[:, 1:].mean(axis=1)
+
+    def __repr__(self):
+        return f"<Sweep {self.path.name}>"
+
+
+class SweepStack:
+    """
+    Many sweeps treated as one virtual array of dim((sweeps, steps, reps+1)). Sweeps are only opened when indexed so
+    comparing many long runs only needs memory for the windows actually used.
+    """
+
+    def __init__(self, sweeps):
+        self.sweeps = [sweep if isinstance(sweep, Sweep) else Sweep(sweep) for sweep in sweeps]
+
+    def __len__(self):
+        return len(self.sweeps)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return SweepStack(self.sweeps[item])
+        return self.sweeps[item]
+
+    def filter(self, **metadata):
+        """ Sweeps whose metadata matches all of the given values, e.g. stack.filter(laser="TUNICS") """
+        return SweepStack([sweep for sweep in self.sweeps
+                           if all(sweep.metadata.get(key) == value for key, value in metadata.items())])
+
+    def window(self, wavelength_start: float, wavelength_end: float):
+        """ List of the rows of every sweep within the wavelength window """
+        return [sweep.window(wavelength_start, wavelength_end) for sweep in self.sweeps]
+
+    def interpolate(self, wavelengths):
+        """ Mean power of every sweep interpolated onto a common wavelength grid, dim((sweeps, len(wavelengths))).
+        Sweeps are read one at a time and only over the range of the grid """
+        wavelengths = np.asarray(wavelengths)
+        result = np.full((len(self.sweeps), len(wavelengths)), np.nan)
+        for i, sweep in enumerate(self.sweeps):
+            sweep_wavelengths, mean_power = sweep.mean_power(wavelengths.min(), wavelengths.max())
+            if len(sweep_wavelengths):
+                order = np.argsort(sweep_wavelengths, kind="stable")
+                result[i] = np.interp(wavelengths, sweep_wavelengths[order], mean_power[order],
+                                      left=np.nan, right=np.nan)
+        return result
+
+
+def find_sweeps(pattern: str = "*", directory: Path = None):
+    """ SweepStack of every sweep file in the data directory matching a glob pattern, oldest first. Where a sweep
+    has both a .txt and .npy file only the .npy is used """
+    directory = data_directory if directory is None else Path(directory)
+    paths = [path for path in directory.rglob(pattern) if path.suffix == ".npy" or
+             (path.suffix == ".txt" and not path.with_suffix(".npy").exists())]
+    return SweepStack(sorted(paths, key=lambda path: path.stat().st_mtime))
+
+
+def decimate_minmax(x, y, n_bins: int):
+    """
+    Reduce (x, y) to the points with the minimum and maximum y in each of n_bins bins of consecutive points. Unlike
+    taking every nth point this keeps every resonance dip however narrow.
+    """
+    x, y = np.asarray(x), np.asarray(y, dtype=float)
+    if len(y) <= 2 * n_bins:
+        return x, y
+    bin_size = -(-len(y) // n_bins)
+    padded = np.full(n_bins * bin_size, np.nan)
+    padded[:len(y)] = y
+    padded = padded.reshape(n_bins, bin_size)
+    # Bins which are all NaN, e.g. a run of skipped points, have no minimum or maximum to keep
+    valid = ~np.all(np.isnan(padded), axis=1)
+    padded = padded[valid]
+    offsets = np.flatnonzero(valid) * bin_size
+    indices = np.unique(np.concatenate((np.nanargmin(padded, axis=1) + offsets,
+                                        np.nanargmax(padded, axis=1) + offsets)))
+    return x[indices], y[indices]
+
+
+def plot_sweep(fname: str, title: str = "", save: bool = True, max_points: int = 20000, dpi: int = 600):
+    """
+    Function to plot the laser sweeps. Get graph of mean power against wavelength
+
+    Sweeps with more than max_points points are reduced with decimate_minmax before plotting. If the figure has
+    already been saved since the sweep file last changed it is not plotted again.
+    Returns the path to the figure
+    """
+    path = data_directory/fname
+    save_path = path.with_suffix(".png")
+    if save and save_path.exists() and save_path.stat().st_mtime >= path.stat().st_mtime:
+        return save_path
+
+    data = load_sweep(fname).sort_index()
+    mean_dbm = data.mean(axis=1)
+    wavelength, mean_dbm = decimate_minmax(mean_dbm.index.values, mean_dbm.values, max_points // 2)
+    data = pd.DataFrame({"Wavelength(nm)": wavelength, "mean_dbm": mean_dbm})
     sns_plot = sns.relplot(data=data, x="Wavelength(nm)", y="mean_dbm", s=5)
     sns_plot.set_axis_labels("Wavelength (nm)", "Power (dBm)")
     if title:
@@ -99,29 +266,198 @@ def plot_sweep(fname: str, title: str = "", save: bool = True):
     fig = sns_plot.fig
     if save:
         print(fr"Saving figure to {save_path}")
-        fig.savefig(save_path, dpi=600, bbox_inches='tight')
+        fig.savefig(save_path, dpi=dpi, bbox_inches='tight')
+        plt.close(fig)
+    return save_path
 
 
-def get_minima(coarse_power, coarse_wavelength, width: float = 15, thr: float = 2):
+_plot_executor = None
+
+
+def _can_plot_in_background():
+    """ A spawned process (the only kind on Windows) imports the main script again, which would run a script without
+    an `if __name__ == "__main__":` guard, instrument connections and sweeps included, in the plotting process.
+    Daemon processes, e.g. pool workers, can't start processes of their own """
+    if multiprocessing.current_process().daemon:
+        return False
+    return multiprocessing.get_start_method() == "fork" or getattr(sys.modules["__main__"], "__file__", None) is None
+
+
+def plot_sweep_async(fname: str, title: str = "", save: bool = True, **kwargs):
+    """
+    Run plot_sweep in a background process so that the next measurement isn't held up by plotting. Plots are made
+    one at a time in the order they are requested. Returns a Future of the path to the figure.
+
+    Where processes are spawned rather than forked (Windows, macOS) and the sweeps are run from a script, the plot is
+    made straight away instead, as the script may not be guarded against being run again by the plotting process
+    """
+    global _plot_executor
+    if not _can_plot_in_background():
+        future = Future()
+        try:
+            future.set_result(plot_sweep(fname, title, save, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        _report_plot_error(future)
+        return future
+    if _plot_executor is None:
+        _plot_executor = ProcessPoolExecutor(max_workers=1)
+    future = _plot_executor.submit(plot_sweep, fname, title, save, **kwargs)
+    future.add_done_callback(_report_plot_error)
+    return future
+
+
+def _report_plot_error(future):
+    if future.exception() is not None:
+        print(f"Plotting failed: {future.exception()!r}")
+
+
+def get_minima(coarse_power, coarse_wavelength, width: float = 15, thr: float = 2, verbose: bool = True):
     """
     Function to return the minima of a coarse ring sweep
 
     Arguments:
-    coarse_power: array of power readings from coarse scan
+    coarse_power: array of power readings from coarse scan, dim((reps, steps))
     coarse_wavelength: wavelength from coarse scan.
     width: bin size of the resonances. Set to 15*(coarse scan resolution) to exclude any minima from the same resonance
+    verbose: if True, print the resonances found
 
     Returns:
-    resonances: list of wavelengths where resonances occur. To be fed into resonance_finding function
+    resonances: array of wavelengths where resonances occur. To be fed into resonance_finding function
     minima: indices of wavelength array where resonances occur.
     """
-
-    mean_power = -1*np.array([np.mean(coarse_power[:, i])
-                              for i in range(len(coarse_wavelength))])
+    mean_power = -np.atleast_2d(coarse_power).mean(axis=0)
     minima, _ = find_peaks(mean_power, height=0,
                            distance=width, threshold=thr)
-    resonances = coarse_wavelength[minima]
-    print(f"Resonances occuring at {resonances} nm")
+    resonances = np.asarray(coarse_wavelength)[minima]
+    if verbose:
+        print(f"Resonances occuring at {resonances} nm")
 
     return minima, resonances
+
+
+class ResonanceDetector:
+    """
+    Finds the same minima as get_minima but on a sweep which arrives in chunks, so resonances can be acted on while
+    the scan is still running.
+
+    Feed it the wavelengths and dim((reps, n)) power readings of each new chunk of points with update(). The mean
+    and variance over the repetitions are kept for every point along with a running mean and variance of the whole
+    sweep. Call finish() after the last chunk to report the minima which are still undecided.
+
+    Candidates are the minima which pass height and thr, which only depend on their neighbours. As in find_peaks, a
+    candidate is dropped if a deeper candidate less than `width` points away is kept, and that one could in turn be
+    dropped by a deeper one further on, so a candidate is only decided once every deeper candidate within `width` of
+    it is, and only reported once every candidate before it is decided. Only the undecided candidates and the new
+    points are looked at by each update, so the cost per point doesn't grow with the length of the sweep. Minima of
+    exactly equal depth within `width` of each other may be resolved differently to find_peaks.
+
+    Arguments:
+    width, thr: as get_minima
+    on_resonance: optional function called with the wavelength of each resonance as it is found
+    """
+
+    def __init__(self, width: int = 15, thr: float = 2, on_resonance=None):
+        self.width = int(np.ceil(width))
+        self.thr = thr
+        self.on_resonance = on_resonance
+        self.n = 0
+        self._wavelengths = np.empty(1024)
+        self._mean = np.empty(1024)
+        self._variance = np.empty(1024)
+        self._scan_start = 0  # first point which the next search for candidates has to look at
+        self._candidates = []  # [index, kept] of candidates still needed, kept is None until decided
+        self.minima = []
+        # Running statistics of the mean power over the whole sweep
+        self.sweep_mean = 0.0
+        self._sweep_m2 = 0.0
+
+    @property
+    def wavelengths(self):
+        return self._wavelengths[:self.n]
+
+    @property
+    def mean_power(self):
+        return self._mean[:self.n]
+
+    @property
+    def variance(self):
+        return self._variance[:self.n]
+
+    @property
+    def sweep_variance(self):
+        return self._sweep_m2 / (self.n - 1) if self.n > 1 else np.nan
+
+    @property
+    def resonances(self):
+        return self.wavelengths[self.minima]
+
+    def update(self, wavelengths, power_readings):
+        """ Add a chunk of points and return the wavelengths of any newly found resonances """
+        wavelengths = np.atleast_1d(wavelengths)
+        power_readings = np.asarray(power_readings, dtype=float).reshape(-1, len(wavelengths))
+        if self.n + len(wavelengths) > len(self._wavelengths):
+            capacity = max(2 * len(self._wavelengths), self.n + len(wavelengths))
+            for name in ("_wavelengths", "_mean", "_variance"):
+                grown = np.empty(capacity)
+                grown[:self.n] = getattr(self, name)[:self.n]
+                setattr(self, name, grown)
+
+        chunk = slice(self.n, self.n + len(wavelengths))
+        chunk_mean = power_readings.mean(axis=0)
+        self._wavelengths[chunk] = wavelengths
+        self._mean[chunk] = chunk_mean
+        self._variance[chunk] = power_readings.var(axis=0, ddof=1) if len(power_readings) > 1 else 0
+
+        # Chan et al. parallel update of the running mean and variance
+        n_chunk = len(chunk_mean)
+        delta = chunk_mean.mean() - self.sweep_mean
+        total = self.n + n_chunk
+        self.sweep_mean += delta * n_chunk / total
+        self._sweep_m2 += ((chunk_mean - chunk_mean.mean()) ** 2).sum() + delta ** 2 * self.n * n_chunk / total
+        self.n = total
+
+        # A run of equal points at the end could still become a flat minimum, so candidates are only known before it
+        run_start = self.n - 1
+        while run_start > self._scan_start and self._mean[run_start - 1] == self._mean[self.n - 1]:
+            run_start -= 1
+        return self._search(run_start)
+
+    def finish(self):
+        """ Report the resonances still undecided at the end of the sweep """
+        return self._search(self.n + self.width)
+
+    def _search(self, known: int):
+        """ Find new candidates and decide what can be, given that every candidate before point known is found """
+        last = self._candidates[-1][0] if self._candidates else -1
+        peaks, _ = find_peaks(-self._mean[self._scan_start:self.n], height=0, threshold=self.thr)
+        self._candidates += [[int(peak), None] for peak in peaks + self._scan_start if peak > last]
+        self._scan_start = max(min(known, self.n) - 1, 0)
+
+        # Deepest first, so any deeper candidate which can be decided already is
+        for candidate in sorted((c for c in self._candidates if c[1] is None), key=lambda c: self._mean[c[0]]):
+            index = candidate[0]
+            deeper = [kept for other, kept in self._candidates
+                      if abs(other - index) < self.width and self._mean[other] < self._mean[index]]
+            if True in deeper:
+                candidate[1] = False
+            elif None not in deeper and index + self.width <= known:
+                candidate[1] = True
+
+        undecided = [index for index, kept in self._candidates if kept is None]
+        boundary = undecided[0] if undecided else self.n
+        reported = self.minima[-1] if self.minima else -1
+        new = [index for index, kept in self._candidates if kept and reported < index < boundary]
+        # Decided candidates are only needed while they are within width of one which isn't
+        oldest = (undecided[0] if undecided else self._scan_start + 1) - self.width
+        self._candidates = [candidate for candidate in self._candidates if candidate[0] > oldest]
+
+        self.minima += new
+        resonances = self._wavelengths[new]
+        if self.on_resonance is not None:
+            for resonance in resonances:
+                self.on_resonance(resonance)
+        return list(resonances)
+
+
 # %%
@@ -0,0 +1,84 @@
+""" This file is for averaging each point of a sweep only as long as it needs, instead of a fixed number of readings
+
+Flat, quiet parts of a sweep reach a given precision in a few readings while the bottom of a resonance, where there
+is little light, needs many more. AdaptiveAveraging keeps reading each point until the standard error of its mean
+is below a target.
+
+setup.perform_wavelength_sweep(1540, 1560, 0.01, averaging=AdaptiveAveraging(target=0.005))
+setup.samples  # power meter samples averaged at each point
+"""
+import numpy as np
+
+
+class AdaptiveAveraging:
+    """
+    Reads a point until the standard error of the mean reading, in dB, is at most target. After min_readings
+    readings the spread so far gives the number of readings still needed, which are asked for in one transaction, so
+    most points take one or two round trips.
+
+    The power meter's own averaging count sets how many samples go into each reading. With adjust_average, it is set
+    for each point from the spread at the previous one, so that min_readings readings are expected to be enough:
+    fewer samples per reading on the baseline and more in a resonance. It is only changed when it is out by more than
+    a factor of two, as each change is another command, is lowered by at most half at a time, and is put back at the
+    end of the sweep.
+
+    Arguments:
+    target: standard error in dB to reach at each point
+    min_readings: readings taken at every point, at least 2 for their spread to be known
+    max_readings: most readings taken at a point, however noisy it is
+    adjust_average: if True, also adjust the power meter's averaging count as above
+    min_average, max_average: range of the averaging count when adjust_average
+    """
+
+    def __init__(self, target: float = 0.01, min_readings: int = 3, max_readings: int = 100,
+                 adjust_average: bool = False, min_average: int = 1, max_average: int = 10000):
+        if min_readings < 2:
+            raise ValueError(f"min_readings of {min_readings} must be at least 2 to estimate the standard error")
+        if max_readings < min_readings:
+            raise ValueError(f"max_readings of {max_readings} is below min_readings of {min_readings}")
+        self.target = target
+        self.min_readings = min_readings
+        self.max_readings = max_readings
+        self.adjust_average = adjust_average
+        self.min_average = min_average
+        self.max_average = max_average
+
+    def read(self, power_meter):
+        """
+        Read a point until the standard error of its mean is at most target or max_readings have been taken.
+
+        Returns:
+        readings: array of the readings taken
+        average: power meter averaging count they were taken with
+        """
+        average = power_meter.get_average()
+        readings = np.asarray(power_meter.read_burst(self.min_readings), dtype=float)
+        while len(readings) < self.max_readings:
+            spread = readings.std(ddof=1)
+            if spread <= self.target * np.sqrt(len(readings)):
+                break
+            # The readings needed for the standard error spread / sqrt(n) to reach target
+            needed = int(np.ceil((spread / self.target) ** 2)) - len(readings)
+            more = min(max(needed, 1), self.max_readings - len(readings))
+            readings = np.concatenate((readings, np.asarray(power_meter.read_burst(more), dtype=float)))
+
+        if self.adjust_average:
+            self._adjust_average(power_meter, readings, average)
+        return readings, average
+
+    def _adjust_average(self, power_meter, readings, average: int):
+        # The spread of single samples, as each reading is the mean of average samples
+        sample_spread = readings.std(ddof=1) * np.sqrt(average)
+        wanted = int(np.clip(np.ceil((sample_spread / self.target) ** 2 / self.min_readings), self.min_average,
+                             self.max_average))
+        if wanted > 2 * average:
+            power_meter.set_average(wanted)
+        elif wanted < average / 2:
+            # Lowered at most by half at a time, as the spread of a few readings can easily be underestimated
+            power_meter.set_average(max(wanted, average // 2, self.min_average))
+
+    def describe(self):
+        """ The settings as a dict for the metadata and checkpoint of a sweep """
+        return {"target": self.target, "min_readings": self.min_readings, "max_readings": self.max_readings,
+                "adjust_average": self.adjust_average, "min_average": self.min_average,
+                "max_average": self.max_average}
@@ -0,0 +1,279 @@
+""" This file is for benchmarking the sweeps and analysis against the simulated instruments in core.simulation
+
+Results are appended to Benchmarks/results.jsonl and every run is compared with the last run of the same benchmark
+and parameters, so that a slower control loop is noticed before it costs time on the real instruments.
+
+python -m core.benchmark --sweep-sizes 100 1000 --latency 0.002
+"""
+import argparse
+import datetime
+import json
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+from core.analysis import get_minima, plot_sweep
+from core.control import plan_resonance_windows
+from core.simulation import SimulatedBench, simulated_setup
+from core.utils import root, sweep_writer
+
+results_path = root/"Benchmarks"/"results.jsonl"
+
+# Simulated instruments a little faster than the real ones so that the larger sweeps finish in reasonable time
+DEFAULT_INSTRUMENT = {"latency": 0.0005, "command_latency": 0.00005, "sample_time": 0.0001, "settle_time": 0.0005,
+                      "settle_time_per_nm": 0.01, "average": 1}
+SWEEP_SIZES = (100, 1000, 10000)
+ANALYSIS_SIZES = (100, 1000, 10000, 100000, 1000000)
+
+
+def _simulated_setup(laser: str, latency: float, command_latency: float, sample_time: float, settle_time: float,
+                     settle_time_per_nm: float, average: int):
+    bench = SimulatedBench(settle_time=settle_time, settle_time_per_nm=settle_time_per_nm, seed=0)
+    return simulated_setup(laser, bench, average, power_meter_kwargs={"sample_time": sample_time},
+                           latency=latency, command_latency=command_latency)
+
+
+def _round_trips(setup):
+    return setup.laser.instrument.round_trips + setup.power_meter.instrument.round_trips
+
+
+def benchmark_wavelength_sweep(points: int, laser: str = "QUANTIFI", reps: int = 1, track_sensitivity: bool = False,
+                               **instrument):
+    """ perform_wavelength_sweep of points points across the whole range of the laser """
+    setup = _simulated_setup(laser, **instrument)
+    start, end = setup.laser.get_limits("wavelength")
+    # The last point is kept clear of the maximum so that rounding in the sweep can't take it past the limit
+    res = (end - start) / (points + 1)
+    # The simulated laser is allowed a finer resolution so that the largest sweeps fit in its range
+    setup.laser.resolution = min(setup.laser.resolution, res)
+
+    round_trips = _round_trips(setup)
+    t = time.perf_counter()
+    readings = setup.perform_wavelength_sweep(start, start + (points - 1) * res, res, graph=False, save=False, verbose=False,
+                                              reps=reps, track_sensitivity=track_sensitivity)
+    seconds = time.perf_counter() - t
+    points = readings.shape[1]
+    return {"points": points, "seconds": seconds, "points_per_second": points / seconds,
+            "round_trips_per_point": (_round_trips(setup) - round_trips) / points,
+            "settle_overhead": float(np.nansum(setup.settle_times)) / seconds,
+            "mean_settle_time": float(np.nanmean(setup.settle_times)),
+            "phase_seconds_per_point": {name: phase["total"] / points
+                                        for name, phase in setup.timings.summary().items()}}
+
+
+def benchmark_resonance_finding(points: int, laser: str = "QUANTIFI", reps: int = 1, width: float = 0.15,
+                                **instrument):
+    """ resonance_finding of every resonance of the simulated ring within the laser's range, points in total """
+    setup = _simulated_setup(laser, **instrument)
+    start, end = setup.laser.get_limits("wavelength")
+    resonances = setup.power_meter.instrument.bench.device.resonances(start + width, end - width)
+    res = 2 * width * len(resonances) / points
+    setup.laser.resolution = min(setup.laser.resolution, res)
+
+    points = sum(len(window) for window in plan_resonance_windows(resonances, width, res))
+    round_trips = _round_trips(setup)
+    t = time.perf_counter()
+    setup.resonance_finding(resonances, width, graph=False, res=res, reps=reps, verbose=False, save=False)
+    seconds = time.perf_counter() - t
+    return {"points": points, "seconds": seconds, "points_per_second": points / seconds,
+            "round_trips_per_point": (_round_trips(setup) - round_trips) / points}
+
+
+def _coarse_sweep(points: int, reps: int = 1):
+    bench = SimulatedBench(seed=0)
+    wavelengths = np.linspace(1500, 1640, points)
+    power = 10 * np.log10(bench.device.transmission(wavelengths)) - bench.insertion_loss
+    return wavelengths, power + bench.rng.normal(0, bench.noise, (reps, points))
+
+
+def benchmark_get_minima(points: int):
+    wavelengths, power = _coarse_sweep(points)
+    t = time.perf_counter()
+    get_minima(power, wavelengths, verbose=False)
+    seconds = time.perf_counter() - t
+    return {"points": points, "seconds": seconds, "points_per_second": points / seconds}
+
+
+def benchmark_plot_sweep(points: int):
+    wavelengths, power = _coarse_sweep(points)
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory)/"sweep.npy"
+        np.save(path, np.column_stack((wavelengths, power.T)))
+        t = time.perf_counter()
+        plot_sweep(str(path))
+        seconds = time.perf_counter() - t
+    return {"points": points, "seconds": seconds, "points_per_second": points / seconds}
+
+
+def benchmark_file_write(points: int, file_format: str = ".txt", reps: int = 1):
+    """ Streaming points rows into a sweep file one row at a time, as the sweeps do """
+    wavelengths, power = _coarse_sweep(points, reps)
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory)/f"sweep{file_format}"
+        t = time.perf_counter()
+        with open(path, "w" if file_format == ".txt" else "wb") as f, sweep_writer(f, reps) as writer:
+            for i, wavelength in enumerate(wavelengths):
+                writer.append(wavelength, power[:, i])
+        seconds = time.perf_counter() - t
+        size = path.stat().st_size
+    return {"points": points, "seconds": seconds, "points_per_second": points / seconds,
+            "seconds_per_point": seconds / points, "bytes_per_point": size / points}
+
+
+BENCHMARKS = {"wavelength_sweep": benchmark_wavelength_sweep, "resonance_finding": benchmark_resonance_finding,
+              "get_minima": benchmark_get_minima, "plot_sweep": benchmark_plot_sweep,
+              "file_write_txt": lambda points: benchmark_file_write(points, ".txt"),
+              "file_write_npy": lambda points: benchmark_file_write(points, ".npy")}
+INSTRUMENT_BENCHMARKS = ("wavelength_sweep", "resonance_finding")
+
+
+def run_benchmark(name: str, points: int, memory: bool = True, **parameters):
+    """
+    Run one benchmark and return its result.
+
+    Peak memory is measured with tracemalloc in a second run, as tracing slows down the first.
+    """
+    result = BENCHMARKS[name](points, **parameters)
+    if memory:
+        tracemalloc.start()
+        try:
+            BENCHMARKS[name](points, **parameters)
+            result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {"benchmark": name, "size": points, "parameters": parameters, **result}
+
+
+def run_benchmarks(names=None, sweep_sizes=SWEEP_SIZES, analysis_sizes=ANALYSIS_SIZES, memory: bool = True,
+                   verbose: bool = True, **instrument):
+    """
+    Run benchmarks at every size.
+
+    Arguments:
+    names: names of the benchmarks in BENCHMARKS to run, all of them if None
+    sweep_sizes: numbers of points of the benchmarks which sweep the simulated instruments
+    analysis_sizes: numbers of points of the other benchmarks
+    memory: if True, also measure the peak memory of every benchmark
+    instrument: simulated instrument parameters overriding DEFAULT_INSTRUMENT and laser
+
+    Returns:
+    list of results, one dict per benchmark and size
+    """
+    names = BENCHMARKS if names is None else names
+    instrument = {**DEFAULT_INSTRUMENT, **instrument}
+    timestamp = datetime.datetime.now().isoformat(timespec="seconds")
+    commit = _commit()
+    results = []
+    for name in names:
+        for points in (sweep_sizes if name in INSTRUMENT_BENCHMARKS else analysis_sizes):
+            result = run_benchmark(name, int(points), memory,
+                                   **(instrument if name in INSTRUMENT_BENCHMARKS else {}))
+            results.append({"timestamp": timestamp, "commit": commit, **result})
+            if verbose:
+                print(_format(result))
+    return results
+
+
+def _format(result: dict):
+    line = f"{result['benchmark']:<18} {result['size']:>8} points {result['points_per_second']:>12.1f} points/s"
+    if "round_trips_per_point" in result:
+        line += f" {result['round_trips_per_point']:6.2f} round trips/point"
+    if "settle_overhead" in result:
+        line += f" {100 * result['settle_overhead']:5.1f}% settling"
+    if "peak_memory" in result:
+        line += f" {result['peak_memory'] / 1e6:8.2f} MB peak"
+    return line
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(path: Path = results_path):
+    if not Path(path).exists():
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_results(results: list, path: Path = results_path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+
+
+def compare(results: list, previous: list, tolerance: float = 0.2):
+    """
+    Compare results with the last of the previous results of the same benchmark, size and parameters.
+
+    Returns:
+    list of messages describing every benchmark which is more than tolerance (a fraction) slower, or uses more than
+    tolerance more memory, than before
+    """
+    last = {}
+    for result in previous:
+        last[_key(result)] = result
+
+    regressions = []
+    for result in results:
+        before = last.get(_key(result))
+        if before is None:
+            continue
+        if result["points_per_second"] < (1 - tolerance) * before["points_per_second"]:
+            regressions.append(f"{result['benchmark']} ({result['size']} points): "
+                               f"{result['points_per_second']:.1f} points/s, was "
+                               f"{before['points_per_second']:.1f} at {before.get('commit')}")
+        if "peak_memory" in result and "peak_memory" in before and \
+                result["peak_memory"] > (1 + tolerance) * before["peak_memory"]:
+            regressions.append(f"{result['benchmark']} ({result['size']} points): "
+                               f"{result['peak_memory'] / 1e6:.2f} MB peak memory, was "
+                               f"{before['peak_memory'] / 1e6:.2f} MB at {before.get('commit')}")
+    return regressions
+
+
+def _key(result: dict):
+    return result["benchmark"], result["size"], json.dumps(result["parameters"], sort_keys=True)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the sweeps against simulated instruments")
+    parser.add_argument("benchmarks", nargs="*", help=f"benchmarks to run from {', '.join(BENCHMARKS)}, default all")
+    parser.add_argument("--sweep-sizes", nargs="+", type=float, default=SWEEP_SIZES)
+    parser.add_argument("--analysis-sizes", nargs="+", type=float, default=ANALYSIS_SIZES)
+    parser.add_argument("--laser", choices=("QUANTIFI", "TUNICS"), default="QUANTIFI")
+    for name, value in DEFAULT_INSTRUMENT.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    parser.add_argument("--no-memory", action="store_true", help="don't measure peak memory")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="fractional slow down or memory increase reported as a regression")
+    parser.add_argument("--results", type=Path, default=results_path)
+    parser.add_argument("--no-save", action="store_true", help="don't append the results to --results")
+    args = parser.parse_args(args)
+    if unknown := set(args.benchmarks) - set(BENCHMARKS):
+        parser.error(f"unknown benchmarks {', '.join(sorted(unknown))}")
+
+    instrument = {name: getattr(args, name) for name in DEFAULT_INSTRUMENT}
+    results = run_benchmarks(args.benchmarks or None, args.sweep_sizes, args.analysis_sizes, not args.no_memory,
+                             laser=args.laser, **instrument)
+    regressions = compare(results, load_results(args.results), args.tolerance)
+    if not args.no_save:
+        save_results(results, args.results)
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+""" This file is for running sweeps on several experimental set ups at the same time, e.g. a chip on the Quantifi and
+another on the Tunics
+
+Every set up runs in its own worker process with its own queue of jobs, so a slow sweep on one set up doesn't hold
+up the others, and every worker saves into the same data directory and catalogue.
+
+campaign = Campaign()
+campaign.add_setup("chip_a", instrument_setup, "QUANTIFI", power_meter_resource="USB0::0x1313::0x8078::P0010441::INSTR")
+campaign.add_setup("chip_b", instrument_setup, "TUNICS", power_meter_resource="USB0::0x1313::0x8078::P0012345::INSTR")
+campaign.submit("chip_a", "perform_wavelength_sweep", 1540, 1560, 0.01, graph=False)
+campaign.submit("chip_b", "perform_wavelength_sweep", 1540, 1560, 0.01, graph=False)
+results = campaign.run()
+"""
+import inspect
+import multiprocessing
+import queue
+import time
+import traceback
+
+
+def instrument_setup(laser: str = "QUANTIFI", laser_resource: str = None, power_meter_resource: str = None,
+                     average: int = 100, power: float = None):
+    """
+    An ExperimentalSetUp of real instruments, for use as the factory of a campaign set up. The instruments are
+    opened in the worker process, as VISA resources can't be passed between processes.
+
+    Arguments:
+    laser: QUANTIFI or TUNICS
+    laser_resource, power_meter_resource: VISA resource names, the managers' defaults if None
+    average: power meter averages
+    power: laser power, the manager's default if None
+    """
+    from core.control import ExperimentalSetUp
+    from core.instruments import QuantifiManager, TunicsManager, PowerMeterManager
+
+    managers = {"QUANTIFI": QuantifiManager, "TUNICS": TunicsManager}
+    if laser.upper() not in managers:
+        raise ValueError(f"Laser '{laser}' must be either 'QUANTIFI' or 'TUNICS'")
+    laser_kwargs = {key: value for key, value in (("resource_name", laser_resource), ("power", power))
+                    if value is not None}
+    power_meter_kwargs = {"average": average} if power_meter_resource is None else \
+        {"resource_name": power_meter_resource, "average": average}
+    return ExperimentalSetUp(managers[laser.upper()](**laser_kwargs), PowerMeterManager(**power_meter_kwargs))
+
+
+class SweepJob:
+    """ A call of a method of ExperimentalSetUp, e.g. SweepJob("perform_wavelength_sweep", 1540, 1560, 0.01) """
+
+    def __init__(self, method: str, *args, **kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.id = None
+
+    def __repr__(self):
+        arguments = [repr(arg) for arg in self.args] + [f"{key}={value!r}" for key, value in self.kwargs.items()]
+        return f"{self.method}({', '.join(arguments)})"
+
+
+class JobResult:
+    """ The outcome of a SweepJob: its return value, or the error it raised as a formatted traceback """
+
+    def __init__(self, setup: str, job: SweepJob, result=None, error: str = None, start: float = None,
+                 end: float = None):
+        self.setup = setup
+        self.job = job
+        self.result = result
+        self.error = error
+        self.start = start
+        self.end = end
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def seconds(self):
+        return None if self.start is None or self.end is None else self.end - self.start
+
+    def __repr__(self):
+        return f"<{self.setup}: {self.job} {'ok' if self.ok else 'failed'}>"
+
+
+def _run_setup(name: str, factory, args, kwargs, jobs, results, stop_on_error: bool):
+    """ Worker process of a set up: create it, then run jobs from its queue until a None is taken from it """
+    try:
+        setup = factory(*args, **kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        # Every job of a set up which couldn't be created fails with the reason
+        while (job := jobs.get()) is not None:
+            results.put(JobResult(name, job, error=error))
+        return
+
+    failed = None
+    while (job := jobs.get()) is not None:
+        if failed is not None:
+            results.put(JobResult(name, job, error=f"Not run after an earlier job failed:\n{failed}"))
+            continue
+        kwargs = dict(job.kwargs)
+        method = getattr(setup, job.method, None)
+        # Label the files of each set up so that set ups sweeping at the same time can't save to the same file
+        if method is not None and "filename" in inspect.signature(method).parameters and \
+                kwargs.get("filename") is None:
+            kwargs["filename"] = name
+        start = time.time()
+        try:
+            if method is None:
+                raise AttributeError(f"ExperimentalSetUp has no method '{job.method}'")
+            results.put(JobResult(name, job, method(*job.args, **kwargs), start=start, end=time.time()))
+        except Exception:
+            error = traceback.format_exc()
+            results.put(JobResult(name, job, error=error, start=start, end=time.time()))
+            if stop_on_error:
+                failed = error
+
+
+class Campaign:
+    """
+    Runs queues of sweep jobs on several set ups at once, each in its own worker process.
+
+    Arguments:
+    stop_on_error: if True, the remaining jobs of a set up are not run after one of its jobs fails. The other set ups
+    carry on either way
+    verbose: if True, print each job as it finishes
+    """
+
+    def __init__(self, stop_on_error: bool = False, verbose: bool = True):
+        self.stop_on_error = stop_on_error
+        self.verbose = verbose
+        self.setups = {}  # name: (factory, args, kwargs)
+        self.queues = {}
+        self.processes = {}
+        self.results = []
+        self._context = multiprocessing.get_context()
+        self._results = self._context.Queue()
+        self._submitted = 0
+
+    def add_setup(self, name: str, factory, *args, **kwargs):
+        """
+        Add a set up which will be created in its worker process by factory(*args, **kwargs), e.g. instrument_setup
+        or core.simulation.simulated_setup. The factory and its arguments must be picklable so they can be sent to
+        the worker
+        """
+        if name in self.setups:
+            raise ValueError(f"Set up '{name}' has already been added")
+        self.setups[name] = (factory, args, kwargs)
+        self.queues[name] = self._context.Queue()
+
+    def submit(self, setup: str, method, *args, **kwargs):
+        """ Queue a job on a set up. method is the name of an ExperimentalSetUp method or a SweepJob. Jobs can be
+        submitted before or while the campaign is running. Returns the SweepJob """
+        if setup not in self.queues:
+            raise ValueError(f"Unknown set up '{setup}'")
+        job = method if isinstance(method, SweepJob) else SweepJob(method, *args, **kwargs)
+        job.id = self._submitted
+        self._submitted += 1
+        self.queues[setup].put(job)
+        return job
+
+    def start(self):
+        """ Start a worker process for every set up """
+        for name, (factory, args, kwargs) in self.setups.items():
+            if name in self.processes:
+                continue
+            process = self._context.Process(target=_run_setup, name=f"Campaign-{name}",
+                                            args=(name, factory, args, kwargs, self.queues[name], self._results,
+                                                  self.stop_on_error))
+            process.start()
+            self.processes[name] = process
+
+    def join(self):
+        """ Wait for every job submitted so far to finish and stop the workers. Returns the list of JobResults, in
+        the order the jobs were submitted """
+        for name in self.processes:
+            self.queues[name].put(None)
+        expected = self._submitted - len(self.results)
+        while expected > 0:
+            try:
+                result = self._results.get(timeout=0.5)
+            except queue.Empty:
+                if not any(process.is_alive() for process in self.processes.values()):
+                    break
+                continue
+            expected -= 1
+            self.results.append(result)
+            if self.verbose:
+                print(f"[{result.setup}] {result.job} " +
+                      (f"done in {result.seconds:.1f}s" if result.ok else f"failed\n{result.error}"))
+
+        for name, process in self.processes.items():
+            process.join()
+            if process.exitcode != 0:
+                print(f"Worker of set up '{name}' exited with code {process.exitcode}")
+        self.processes = {}
+        self.queues = {name: self._context.Queue() for name in self.setups}
+        return sorted(self.results, key=lambda result: result.job.id)
+
+    def run(self):
+        """ Run every submitted job and return the list of JobResults once they have all finished """
+        self.start()
+        return self.join()
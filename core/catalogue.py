@@ -0,0 +1,143 @@
+""" This file is for the catalogue of recorded sweeps, an SQLite index of every saved file and its parameters """
+import contextlib
+import datetime
+import json
+import sqlite3
+from pathlib import Path
+
+from core.utils import data_directory, parse_sweep_filename
+
+COLUMNS = ("kind", "laser", "timestamp", "averages", "sensitivity", "start", "stop", "res", "reps", "label")
+
+
+class Catalogue:
+    """
+    Index of the sweep files in the data directory, stored in catalogue.sqlite alongside them. Files are added
+    automatically by open_time_stamped_file when they are saved. Use rebuild() to index files saved before the
+    catalogue existed.
+
+    catalogue = Catalogue()
+    catalogue.query(laser="TUNICS", wavelength=1550, after="2022-11-01")
+    """
+
+    def __init__(self, directory: Path = None):
+        self.directory = data_directory if directory is None else Path(directory)
+        self.path = self.directory/"catalogue.sqlite"
+        with self._connect() as connection:
+            # Write-ahead logging lets the workers of a campaign (see core.campaign) add files while others read
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sweeps (path TEXT PRIMARY KEY, kind TEXT, laser TEXT, timestamp TEXT, "
+                "averages INTEGER, sensitivity REAL, start REAL, stop REAL, res REAL, reps INTEGER, label TEXT, "
+                "metadata TEXT)")
+            connection.execute("CREATE INDEX IF NOT EXISTS sweeps_laser ON sweeps (laser, timestamp)")
+            connection.execute("CREATE INDEX IF NOT EXISTS sweeps_range ON sweeps (start, stop)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with contextlib.closing(sqlite3.connect(self.path, timeout=30)) as connection:
+            with connection:
+                yield connection
+
+    def add(self, path, metadata: dict = None, replace: bool = True):
+        """ Add a file to the catalogue, replacing any previous entry for it if replace. Metadata not given is taken
+        from the .json saved alongside binary sweeps, then from the file name """
+        path = Path(path)
+        if metadata is None and path.with_suffix(".json").exists():
+            with open(path.with_suffix(".json")) as f:
+                metadata = json.load(f)
+        if metadata is None and path.suffix == ".txt":
+            # The wavelengths in the file name are rounded so take the range from the first and last rows
+            metadata = _text_file_range(path)
+        metadata = {**(parse_sweep_filename(path.name) or {}), **(metadata or {})}
+        if "timestamp" not in metadata:
+            metadata["timestamp"] = datetime.datetime.fromtimestamp(path.stat().st_mtime).isoformat()
+        if "start" not in metadata and metadata.get("resonances") and "width" in metadata:
+            # resonance_finding covers a window around each rough resonance
+            metadata["start"] = min(metadata["resonances"]) - metadata["width"]
+            metadata["stop"] = max(metadata["resonances"]) + metadata["width"]
+
+        with self._connect() as connection:
+            connection.execute(
+                f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO sweeps (path, {', '.join(COLUMNS)}, metadata) "
+                f"VALUES ({', '.join('?' * (len(COLUMNS) + 2))})",
+                (self._relative(path), *(metadata.get(column) for column in COLUMNS), json.dumps(metadata)))
+
+    def remove(self, path):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM sweeps WHERE path = ?", (self._relative(Path(path)),))
+
+    def rebuild(self):
+        """ Index every sweep file in the data directory which isn't already in the catalogue. A .npy and .txt of the
+        same sweep are both indexed """
+        for path in self.directory.rglob("*"):
+            if path.suffix in (".txt", ".npy"):
+                self.add(path, replace=False)
+
+    def query(self, laser: str = None, kind: str = None, wavelength: float = None, wavelength_start: float = None,
+              wavelength_end: float = None, after=None, before=None, averages: int = None, label: str = None):
+        """
+        Return the catalogue entries matching all of the given arguments, oldest first, as a list of dicts with the
+        absolute path under "path".
+
+        Arguments:
+        laser: TUNICS or QUANTIFI
+        kind: laser_sweep, resonance_finding or continuous_sweep
+        wavelength: only sweeps covering this wavelength in nm
+        wavelength_start, wavelength_end: only sweeps overlapping this range in nm
+        after, before: datetime or ISO format string, only sweeps taken in this period
+        averages: power meter averages
+        label: only sweeps whose label (the filename given to the sweep) contains this, e.g. a device name
+        """
+        conditions, parameters = [], []
+        for column, value in (("laser", laser), ("kind", kind), ("averages", averages)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+        if wavelength is not None:
+            conditions.append("start <= ? AND stop >= ?")
+            parameters += [wavelength, wavelength]
+        if wavelength_start is not None:
+            conditions.append("stop >= ?")
+            parameters.append(wavelength_start)
+        if wavelength_end is not None:
+            conditions.append("start <= ?")
+            parameters.append(wavelength_end)
+        if after is not None:
+            conditions.append("timestamp >= ?")
+            parameters.append(after.isoformat() if isinstance(after, datetime.datetime) else after)
+        if before is not None:
+            conditions.append("timestamp <= ?")
+            parameters.append(before.isoformat() if isinstance(before, datetime.datetime) else before)
+        if label is not None:
+            conditions.append("label LIKE ?")
+            parameters.append(f"%{label}%")
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._connect() as connection:
+            connection.row_factory = sqlite3.Row
+            rows = connection.execute(f"SELECT * FROM sweeps {where} ORDER BY timestamp", parameters).fetchall()
+        return [{**dict(row), "path": self.directory/row["path"], "metadata": json.loads(row["metadata"])}
+                for row in rows]
+
+    def _relative(self, path: Path):
+        path = path if path.is_absolute() else self.directory/path
+        try:
+            return path.relative_to(self.directory).as_posix()
+        except ValueError:
+            return path.as_posix()
+
+
+def _text_file_range(path: Path):
+    """ Wavelength of the first and last rows of a text sweep file, without reading the rest of it """
+    with open(path, "rb") as f:
+        f.readline()
+        first = f.readline()
+        f.seek(0, 2)
+        f.seek(max(f.tell() - 4096, 0))
+        lines = f.read().splitlines()
+    try:
+        return {"start": float(first.split(b",")[0]), "stop": float(lines[-1].split(b",")[0])}
+    except (ValueError, IndexError):
+        return {}
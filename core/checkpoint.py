@@ -0,0 +1,134 @@
+""" This file is for making long sweeps survive transient instrument errors. A RetryPolicy retries or skips points
+which fail to be measured, and a SweepCheckpoint records the progress of a sweep so that it can be resumed from the
+last point saved after it has stopped
+
+setup.perform_wavelength_sweep(1500, 1600, 0.001, checkpoint="long_sweep.json",
+                               retry=RetryPolicy(retries=3, skip=True))
+# If the sweep stops, running it again with the same arguments carries on from the last point saved
+"""
+import json
+import os
+import time
+from pathlib import Path
+
+from pyvisa.errors import VisaIOError
+
+# Errors which a point is retried after: the laser not settling, instrument errors and VISA timeouts
+TRANSIENT_ERRORS = (TimeoutError, IOError, VisaIOError)
+
+
+class RetryPolicy:
+    """
+    What to do when measuring a point raises a transient error: retry it up to retries times, waiting delay seconds
+    and calling recover (if given) before each retry, then either skip the point or raise the last error.
+
+    Arguments:
+    retries: number of times a point is retried after the first attempt
+    delay: seconds to wait before each retry
+    skip: if True, a point which fails every attempt is skipped (its readings are NaN) instead of stopping the sweep
+    errors: exception types which are retried. Anything else stops the sweep straight away
+    """
+
+    def __init__(self, retries: int = 2, delay: float = 1, skip: bool = False, errors: tuple = TRANSIENT_ERRORS):
+        self.retries = retries
+        self.delay = delay
+        self.skip = skip
+        self.errors = errors
+        self.retried = 0  # retries made so far
+        self.skipped = 0  # points skipped so far
+
+    def attempt(self, measure, recover=None):
+        """ Return measure(), retrying it as set by the policy. Returns None if every attempt failed and skip """
+        for attempt in range(self.retries + 1):
+            try:
+                return measure()
+            except self.errors as e:
+                error = e
+            if attempt < self.retries:
+                self.retried += 1
+                print(f"Retrying point after {type(error).__name__}: {error}")
+                time.sleep(self.delay)
+                if recover is not None:
+                    try:
+                        recover()
+                    except self.errors:
+                        # The retry will fail in turn if the instrument hasn't recovered
+                        pass
+        if not self.skip:
+            raise error
+        self.skipped += 1
+        print(f"Skipping point after {self.retries + 1} attempts: {error}")
+        return None
+
+
+class SweepCheckpoint:
+    """
+    Progress of a sweep saved as JSON: the sweep's parameters, the file it is saving to, the instrument settings
+    it started with, the number of points completed, the window of resonance_finding reached and any points
+    skipped. The file is replaced atomically so a crash while saving leaves the previous checkpoint.
+
+    The data file is the record of which points have been measured, as every row in it has been fsynced, so a
+    sweep resumes after the last complete row in the file rather than from completed.
+
+    Arguments:
+    path: file to save the checkpoint to
+    parameters: dict of the sweep's arguments, which must match for the checkpoint to be resumed
+    """
+
+    def __init__(self, path, parameters: dict, file: str = None, settings: dict = None, completed: int = 0,
+                 window: int = 0, skipped: list = None):
+        self.path = Path(path)
+        self.parameters = parameters
+        self.file = file
+        self.settings = settings or {}
+        self.completed = completed
+        self.window = window
+        self.skipped = skipped or []
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(path, **json.load(f))
+
+    @classmethod
+    def open(cls, path, parameters: dict):
+        """
+        Load the checkpoint at path to resume the sweep with parameters, or make a new one if there is no checkpoint
+        at path or the file it was saving to is gone. Raises ValueError if the checkpoint is of a different sweep,
+        rather than overwriting it.
+        """
+        path = Path(path)
+        # Round trip through JSON so that e.g. tuples and numpy floats compare equal to what was saved
+        parameters = json.loads(json.dumps(parameters, default=float))
+        if path.exists():
+            checkpoint = cls.load(path)
+            if checkpoint.parameters != parameters:
+                raise ValueError(f"Checkpoint {path} is of a different sweep: {checkpoint.parameters}")
+            if checkpoint.file is not None and Path(checkpoint.file).exists():
+                return checkpoint
+        return cls(path, parameters)
+
+    @property
+    def resuming(self):
+        return self.file is not None
+
+    def update(self, **progress):
+        """ Set any of file, settings, completed, window and skipped and save """
+        for name, value in progress.items():
+            setattr(self, name, value)
+        self.save()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_name(self.path.name + ".tmp")
+        with open(temporary, "w") as f:
+            json.dump({"parameters": self.parameters, "file": None if self.file is None else str(self.file),
+                       "settings": self.settings, "completed": self.completed, "window": self.window,
+                       "skipped": self.skipped}, f, indent=4, default=float)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+    def remove(self):
+        """ Delete the checkpoint once the sweep has finished """
+        self.path.unlink(missing_ok=True)
@@ -1,16 +1,29 @@
 """ This file is for functions and classes used to control the instruments """
 import datetime
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import TYPE_CHECKING
 
 from core.instruments import QuantifiManager, PowerMeterManager, TunicsManager
-from core.analysis import data_directory, plot_sweep
-from core.utils import open_time_stamped_file
+from core.utils import open_time_stamped_file, SweepWriter, sweep_writer, recover_sweep_file, load_sweep_rows
+from core.checkpoint import RetryPolicy, SweepCheckpoint
+from core.averaging import AdaptiveAveraging
+from core.monitor import SweepMonitor
+from core.instrumentation import PhaseTimer, write_summary, write_trace
+import contextlib
 import numpy as np
 
+if TYPE_CHECKING:
+    from core.analysis import ResonanceDetector
+
 
 def laser_control(func):
     """ Decorator to be used on methods in ExperimentalSetup where the laser should be turned on. This decorator will
     turn on the laser at the start of method execution then turn it off at the end. If an error occurs mid-execution
     then the laser will be switched off before the error is raised """
+    @functools.wraps(func)
     def error_handler(*args, **kwargs):
         try:
             args[0].laser.set_state(True)
@@ -23,6 +36,79 @@ def laser_control(func):
     return error_handler
 
 
+def plan_resonance_windows(resonance_rough, width: float, res: float, wavelength: float = None):
+    """
+    Plan the points of resonance_finding. Each resonance is swept over the same points as
+    perform_wavelength_sweep(resonance - width, resonance + width + res, res), but windows which overlap or are
+    within res of each other are merged into one window so no point is measured twice. The windows are sorted so that
+    the laser crosses the range once, upwards or downwards from whichever end is nearer wavelength, and so makes one
+    large jump at most.
+
+    Arguments:
+    resonance_rough: wavelengths of the resonances in nm
+    width, res: as resonance_finding
+    wavelength: wavelength in nm the laser starts at. Windows are swept upwards if None
+
+    Returns:
+    windows: list of arrays of the wavelengths of each window, in the order they are to be measured
+    """
+    intervals = sorted((wavelength - width, wavelength + width + res) for wavelength in resonance_rough)
+    merged = []
+    for start, stop in intervals:
+        if merged and start <= merged[-1][1] + res:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    windows = [np.arange(start, stop + res, res) for start, stop in merged]
+
+    if windows and wavelength is not None and abs(wavelength - merged[-1][1]) < abs(wavelength - merged[0][0]):
+        windows = [points[::-1] for points in windows[::-1]]
+    return windows
+
+
+class SweepExecutor:
+    """ Overlaps the independent instrument I/O of a sweep so that the time per point is set by the slowest device
+    rather than the sum of all of them.
+
+    Instrument calls run on the instrument's own worker thread (InstrumentManager.submit), so calls to each instrument
+    keep their order. Rows are written on the sweep's thread, as SweepWriter only writes a block every so often and
+    the checkpoint needs to know which rows are in the file. On exit all outstanding work is waited for and the first
+    error raised by any of it is re-raised.
+    """
+
+    def __init__(self):
+        self._pending = []
+
+    def submit(self, instrument, method: str, *args, **kwargs) -> Future:
+        if hasattr(instrument, "submit"):
+            future = instrument.submit(method, *args, **kwargs)
+        else:
+            # Instruments without a worker, e.g. MockInstrument, are called straight away
+            future = Future()
+            future.set_result(getattr(instrument, method)(*args, **kwargs))
+        self._pending.append(future)
+        return future
+
+    def result(self, future: Future):
+        """ Wait for future and return its result. It is no longer waited for on exit, so an error it raised which
+        has been handled, e.g. by retrying the point, doesn't stop the sweep """
+        self._pending.remove(future)
+        return future.result()
+
+    def wait(self):
+        """ Wait for all outstanding work, raising the first error """
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.wait()
+
+
 class ExperimentalSetUp:
     """ Class used to handle the experimental setup of a laser with a power meter """
 
@@ -30,10 +116,18 @@ class ExperimentalSetUp:
 
         self.laser = laser
         self.power_meter = power_meter
+        self.settle_times = None  # seconds taken to settle at each point of the last sweep
+        self.skipped_points = []  # wavelengths skipped after failing every retry in the last sweep
+        self.samples = None  # power meter samples averaged at each point of the last sweep
+        self.standard_errors = None  # standard error in dB of each point of the last sweep with adaptive averaging
+        self.timings = PhaseTimer()  # time spent setting, settling, reading, writing and plotting in the last sweep
 
     @laser_control
     def perform_wavelength_sweep(self, wavelength_start: float, wavelength_end: float, res: float, graph: bool = True,
-                                 filename: str = None, save: bool = True, verbose: bool = True, reps=1):
+                                 filename: str = None, save: bool = True, verbose: bool = True, reps=1,
+                                 track_sensitivity: bool = False, file_format: str = ".txt",
+                                 detector: "ResonanceDetector" = None, live_plot: bool = False,
+                                 retry: RetryPolicy = None, checkpoint=None, averaging: AdaptiveAveraging = None):
         """
         Performs a sweep over the given start/stop frequencies. Returns an array of dBm readings
         from the power meter saved as a binary file.
@@ -45,11 +139,24 @@ class ExperimentalSetUp:
         save: if True, will save power_readings as a binary file
         filename: name of file to be saved
         delay: seconds to wait after setting the laser to a new wavelength before taking data from the meter
-        verbose: if True, will print current wavelength being scanned, as well as power meter reading
+        verbose: if True, will show the progress, current wavelength and power meter reading
         reps: no. of repetitions to do measure by
+        track_sensitivity: if True, the power meter correction wavelength is set to each point while the laser settles
+        file_format: ".txt" to save as text or ".npy" to save as binary with the parameters in a .json alongside
+        detector: ResonanceDetector fed every point as it is measured, so resonances are found during the sweep
+        live_plot: if True, show a plot of the sweep which is updated as it runs
+        retry: RetryPolicy for points which raise a transient error, e.g. the laser not settling. Without one the
+        sweep stops at the first error
+        checkpoint: path of a checkpoint file (see core.checkpoint). If it holds the progress of this sweep the sweep
+        carries on from the last point saved, appending to the same file, otherwise progress is saved to it as the
+        sweep runs. It is deleted when the sweep completes
+        averaging: AdaptiveAveraging to read each point until its standard error reaches a target instead of taking
+        reps readings. The mean of each point is saved as a single reading and the samples averaged at each point are
+        recorded in self.samples and the metadata
 
         Returns:
-        power_readings: array object with dim((reps,steps)) of power readings from the power meter
+        power_readings: array object with dim((reps,steps)) of power readings from the power meter. Readings of points
+        skipped are NaN
         If save is true, returns a text file saved as "today+"_laser_sweep_"+filename.txt"
         The text file contains a header line "wavelength_nm power_dbm" followed by lines of the
         laser wavelength and power meter readings.
@@ -59,10 +166,13 @@ class ExperimentalSetUp:
         samples_{power meter averages over samples}_
         sensitivity_{power meter wavelength setting}_
         {laser; either TUNICS or QUANTIFI}_{start wavelength, 0dp}_{end wavelength, 0dp}_{steps}_
-        {filename}.txt
+        {filename}{file_format}
         """
         start_time = datetime.datetime.now().strftime("%d-%m-%Y_%H-%M")
         scan_range = np.arange(wavelength_start, wavelength_end+res, res)
+        if averaging is not None:
+            # Each point is saved as the mean of however many readings it took
+            reps = 1
         power_readings = np.zeros((reps, len(scan_range)))
 
         # add exceptions
@@ -70,11 +180,27 @@ class ExperimentalSetUp:
             raise ValueError(
                 f"Wavelength increase of {res} nm is below laser resolution")
 
+        self.timings = timings = PhaseTimer()
+        self.skipped_points = []
+
+        path, skip = None, 0
+        if checkpoint is not None:
+            if not save:
+                raise ValueError("Only sweeps which are saved can be checkpointed")
+            checkpoint = SweepCheckpoint.open(checkpoint, {
+                "kind": "laser_sweep", "laser": self.laser.name, "start": wavelength_start, "stop": wavelength_end,
+                "res": res, "reps": reps, "file_format": file_format,
+                "averaging": None if averaging is None else averaging.describe()})
+            if checkpoint.resuming:
+                path = checkpoint.file
+                skip = self._resume(checkpoint, power_readings, detector)
+                if verbose:
+                    print(f"Resuming from point {skip} of {len(scan_range)}, saving to {path}")
         if verbose:
             print("-----Conducting laser sweep-----")
             print("Parameters:-----------")
             print("Laser start/stop/res:", wavelength_start, wavelength_end, res)
-            print("Reps:", reps)
+            print("Reps:", reps if averaging is None else f"adaptive to a standard error of {averaging.target} dB")
             print(
                 f"Power meter averaging over {self.power_meter.get_average()} samples")
             print(
@@ -86,88 +212,508 @@ class ExperimentalSetUp:
                         fr"{self.laser.name}_{round(wavelength_start)}_{round(wavelength_end)}_{len(scan_range)}" \
                         fr"{'_' + filename if filename else ''}"
 
-        with open_time_stamped_file(savefile_name, start_time, graph, save) as f:
-            if save:
-                f.write("wavelength_nm ")
-                for j in range(reps):
-                    f.write(f",power_reading_{str(j)}_dbm ")
-                f.write("\n")
+        metadata = {"kind": "laser_sweep", "laser": self.laser.name, "averages": self.power_meter.get_average(),
+                    "sensitivity": self.power_meter.get_wavelength(), "start": wavelength_start,
+                    "stop": wavelength_end, "res": res, "reps": reps, "label": filename or ""}
+        if averaging is not None:
+            metadata["averaging"] = averaging.describe()
+
+        monitor = SweepMonitor(len(scan_range), plot=live_plot, title=filename or "") \
+            if verbose or live_plot else None
+        with open_time_stamped_file(savefile_name, start_time, graph, save, file_format, metadata, path) as f, \
+                sweep_writer(f, reps, metadata, skip) as sink, (monitor or contextlib.nullcontext()):
+            if checkpoint is not None and not checkpoint.resuming:
+                checkpoint.update(file=f.name, settings=self._settings())
+            _, settle_times, samples, standard_errors = self._sweep_points(
+                scan_range, reps, sink, power_readings, skip, track_sensitivity, detector, monitor, retry, checkpoint,
+                averaging)
+            if averaging is not None:
+                # Saved with the file when it is closed
+                metadata["samples"] = samples.tolist()
+                metadata["standard_errors"] = standard_errors.tolist()
+
+        if checkpoint is not None:
+            checkpoint.remove()
+        timings.stop()
+        self.settle_times = settle_times
+        self.samples = samples
+        self.standard_errors = standard_errors
+        if detector is not None:
+            detector.finish()
+        if verbose:
+            print(f"Sweep completed")
+            print(f"Mean settle time {np.nanmean(settle_times):.3f}s")
+            if averaging is not None:
+                print(f"Mean samples per point {samples[samples > 0].mean():.0f}, "
+                      f"median standard error {np.nanmedian(standard_errors):.4f} dB")
+            print("Time per point: " + " ".join(f"{name} {1e3 * phase['mean']:.2f}ms"
+                                                for name, phase in timings.summary().items()))
+
+        return power_readings
+
+    @laser_control
+    def perform_continuous_sweep(self, wavelength_start: float, wavelength_end: float, speed: float,
+                                 step: float = None, lag: float = 0, graph: bool = True, filename: str = None,
+                                 save: bool = True, verbose: bool = True, file_format: str = ".txt"):
+        """
+        Sweeps the laser continuously while the power meter is read as fast as it can. Each reading is timestamped
+        and mapped back to the wavelength the laser had been set to at that time, so no time is spent waiting for
+        the laser to settle at each point. Only supported by lasers with a run_sweep method (QuantifiManager).
 
-            for i, wavelength in enumerate(scan_range):
+        Arguments:
+        wavelength_start: starting wavelength of laser in nm
+        wavelength_end: ending wavelength of laser in nm
+        speed: sweep speed in nm/s
+        step: wavelength step of the laser in nm, defaults to the laser resolution
+        lag: seconds between setting the laser and it reaching the set wavelength. Readings are mapped to the
+        wavelength the laser had been set to lag seconds earlier
+        Remaining arguments are as perform_wavelength_sweep
+
+        Returns:
+        wavelengths: array of the wavelength of each reading
+        power_readings: array of power readings from the power meter
 
-                self.laser.set_wavelength(wavelength)
-                # time.sleep(1) # <20 is okay for Quantifi
+        Save file naming format:
+        {dd-mm-yyyy_hh_mm}_continuous_sweep_
+        samples_{power meter averages over samples}_
+        sensitivity_{power meter wavelength setting}_
+        {laser}_{start wavelength, 0dp}_{end wavelength, 0dp}_{speed}_
+        {filename}{file_format}
+        """
+        if not hasattr(self.laser, "run_sweep"):
+            raise TypeError(f"Laser '{self.laser.name}' does not support continuous sweeps")
+
+        start_time = datetime.datetime.now().strftime("%d-%m-%Y_%H-%M")
+        self.timings = timings = PhaseTimer()
+        self.laser.set_wavelength(wavelength_start)
+        if not self.laser.wait_steady_state():
+            raise TimeoutError(
+                f"Laser has taken more than {self.laser.max_wait_time}s to stabilise")
+
+        if verbose:
+            print("-----Conducting continuous laser sweep-----")
+            print("Laser start/stop/speed:", wavelength_start, wavelength_end, speed)
+
+        # The laser stays at each wavelength for this long, the last one included
+        dwell = (self.laser.resolution if step is None else step) / speed
+        timestamps, readings = [], []
+        stop_event = threading.Event()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            sweep = executor.submit(self.laser.run_sweep, wavelength_start, wavelength_end, speed, step,
+                                    stop_event)
+            try:
+                end = np.inf
+                while time.perf_counter() < end:
+                    before = time.perf_counter()
+                    reading = float(self.power_meter.read())
+                    after = time.perf_counter()
+                    timings.add("read", before, after)
+                    timestamps.append((before + after) / 2)
+                    readings.append(reading)
+                    if end == np.inf and sweep.done():
+                        laser_log = sweep.result()
+                        end = laser_log[-1, 0] + dwell + lag
+            except (Exception, KeyboardInterrupt) as e:
+                stop_event.set()
+                raise e
+
+        # Only keep readings taken while the laser was sweeping
+        timestamps = np.array(timestamps) - lag
+        in_sweep = (timestamps >= laser_log[0, 0]) & (timestamps < laser_log[-1, 0] + dwell)
+        set_times = np.searchsorted(laser_log[:, 0], timestamps[in_sweep], side="right") - 1
+        wavelengths = laser_log[set_times, 1]
+        power_readings = np.array(readings)[in_sweep]
+
+        savefile_name = fr"continuous_sweep_samples_{str(self.power_meter.get_average())}" + \
+                        fr"_sensitivity_{str(int(self.power_meter.get_wavelength()))}_" + \
+                        fr"{self.laser.name}_{round(wavelength_start)}_{round(wavelength_end)}_{speed}" \
+                        fr"{'_' + filename if filename else ''}"
+
+        metadata = {"kind": "continuous_sweep", "laser": self.laser.name,
+                    "averages": self.power_meter.get_average(), "sensitivity": self.power_meter.get_wavelength(),
+                    "start": wavelength_start, "stop": wavelength_end, "speed": speed, "reps": 1,
+                    "label": filename or ""}
+        with timings.phase("write"), \
+                open_time_stamped_file(savefile_name, start_time, graph, save, file_format, metadata) as f, \
+                sweep_writer(f, 1, metadata) as writer:
+            writer.extend(wavelengths, power_readings[np.newaxis, :])
+        timings.stop()
+
+        if verbose:
+            print(f"Sweep completed: {len(power_readings)} readings in {laser_log[-1, 0] - laser_log[0, 0]:.1f}s")
+
+        return wavelengths, power_readings
+
+    def _sweep_points(self, points, reps: int, sink: SweepWriter, power_readings=None, skip: int = 0,
+                      track_sensitivity: bool = False, detector: "ResonanceDetector" = None,
+                      monitor: SweepMonitor = None, retry: RetryPolicy = None, checkpoint: SweepCheckpoint = None,
+                      averaging: AdaptiveAveraging = None):
+        """
+        Measure each of points in turn, streaming the rows into sink. The point loop of perform_wavelength_sweep and
+        resonance_finding, which handle the laser, files and checkpoint creation. Arguments are as
+        perform_wavelength_sweep, with power_readings an array of dim((reps, len(points))) to fill in and skip the
+        number of points at the start already in sink, e.g. when resuming. With averaging each point is the mean of
+        the readings it took, so reps is 1.
+
+        Returns:
+        power_readings: as perform_wavelength_sweep
+        settle_times: seconds taken to settle at each point, NaN where not measured
+        samples: power meter samples averaged at each point, 0 where not measured
+        standard_errors: standard error in dB of each point with averaging, otherwise NaN
+        """
+        timings = self.timings
+        if power_readings is None:
+            power_readings = np.full((reps, len(points)), np.nan)
+        settle_times = np.full(len(points), np.nan)
+        samples = np.zeros(len(points), dtype=int)
+        standard_errors = np.full(len(points), np.nan)
+        average = self.power_meter.get_average() if hasattr(self.power_meter, "get_average") else 1
+
+        def read(i):
+            if averaging is None:
+                samples[i] = reps * average
+                return self.power_meter.read_burst(reps)
+            readings, point_average = averaging.read(self.power_meter)
+            samples[i] = len(readings) * point_average
+            standard_errors[i] = readings.std(ddof=1) / np.sqrt(len(readings))
+            return [readings.mean()]
+
+        with SweepExecutor() as executor, self._restoring_average(averaging):
+            def measure(i, wavelength):
+                with timings.phase("set"):
+                    self.laser.set_wavelength(wavelength)
+                    if track_sensitivity:
+                        correction = executor.submit(self.power_meter, "set_wavelength", wavelength)
+                settle_start = time.perf_counter()
                 if self.laser.wait_steady_state() == True:
-                    for j in range(reps):
-                        power_readings[j, i] = self.power_meter.read()
+                    settle_times[i] = time.perf_counter() - settle_start
+                    timings.add("settle", settle_start, settle_start + settle_times[i])
+                    with timings.phase("read"):
+                        if track_sensitivity:
+                            executor.result(correction)
+                        return read(i)
                 else:
                     raise TimeoutError(
                         f"Laser has taken more than {self.laser.max_wait_time}s to stabilise")
 
-                if verbose:
-                    print("Current laser frequency:", wavelength)
-                    print("Power meter reading:", power_readings[:, i])
-                    print("----------------------")
+            for i in range(skip, len(points)):
+                wavelength = points[i]
+                readings = measure(i, wavelength) if retry is None else \
+                    retry.attempt(lambda: measure(i, wavelength), self._recover)
+                if readings is None:
+                    # The row is still saved so the file keeps one row per point of the sweep
+                    power_readings[:, i] = np.nan
+                    self.skipped_points.append(float(wavelength))
+                    if checkpoint is not None:
+                        checkpoint.update(skipped=self.skipped_points)
+                else:
+                    power_readings[:, i] = readings
+
+                with timings.phase("write"):
+                    sink.append(wavelength, power_readings[:, i])
+                    if checkpoint is not None and sink.rows_written != checkpoint.completed:
+                        # Only rows which have been flushed to the file count as completed
+                        checkpoint.update(completed=sink.rows_written)
+                if readings is None:
+                    continue
+                if detector is not None:
+                    with timings.phase("detect"):
+                        detector.update(wavelength, power_readings[:, i])
+                if monitor is not None:
+                    with timings.phase("plot"):
+                        monitor.put(wavelength, power_readings[:, i])
+
+        return power_readings, settle_times, samples, standard_errors
+
+    @contextlib.contextmanager
+    def _restoring_average(self, averaging: AdaptiveAveraging = None):
+        """ Put the power meter's averaging count back after averaging has adjusted it """
+        if averaging is None or not averaging.adjust_average:
+            yield
+            return
+        average = self.power_meter.get_average()
+        try:
+            yield
+        finally:
+            if self.power_meter.get_average() != average:
+                self.power_meter.set_average(average)
+
+    def _settings(self):
+        """ The instrument settings which the readings of a sweep depend on, saved in its checkpoint """
+        return {"power": getattr(self.laser, "defined_power", getattr(self.laser, "_defined_power", None)),
+                "averages": self.power_meter.get_average(), "sensitivity": self.power_meter.get_wavelength()}
+
+    def _restore_settings(self, settings: dict):
+        if settings.get("power") is not None:
+            self.laser.set_power(settings["power"])
+        if "averages" in settings:
+            self.power_meter.set_average(settings["averages"])
+        if "sensitivity" in settings:
+            self.power_meter.set_wavelength(settings["sensitivity"])
+
+    def _resume(self, checkpoint: SweepCheckpoint, power_readings, detector: "ResonanceDetector" = None):
+        """ Prepare to carry on a checkpointed sweep: restore the instrument settings it started with and load the
+        readings already saved into power_readings. Returns the number of points already measured """
+        self._restore_settings(checkpoint.settings)
+        self.skipped_points = list(checkpoint.skipped)
+        rows = recover_sweep_file(checkpoint.file)
+        if rows:
+            data = load_sweep_rows(checkpoint.file)[:rows]
+            power_readings[:, :rows] = data[:, 1:].T
+            if detector is not None:
+                for row in data[~np.isnan(data[:, 1])]:
+                    detector.update(row[0], row[1:])
+        return rows
+
+    def _recover(self):
+        """ Called before a point is retried. Any errors still pending from the laser are cleared and it is switched
+        back on in case the error switched it off """
+        if hasattr(self.laser, "sync"):
+            try:
+                self.laser.sync()
+            except IOError:
+                # Already the cause of the retry
+                pass
+        self.laser.set_state(True)
+
+    def _measure_point(self, wavelength: float, reps: int):
+        """ Set the laser to wavelength, wait for it to settle and return reps power meter readings """
+        with self.timings.phase("set"):
+            self.laser.set_wavelength(wavelength)
+        with self.timings.phase("settle"):
+            settled = self.laser.wait_steady_state()
+        if not settled:
+            raise TimeoutError(
+                f"Laser has taken more than {self.laser.max_wait_time}s to stabilise")
+        with self.timings.phase("read"):
+            return np.asarray(self.power_meter.read_burst(reps), dtype=float)
+
+    @laser_control
+    def adaptive_sweep(self, wavelength_start: float, wavelength_end: float, coarse_res: float, target_res: float,
+                       dip_depth: float = 2, max_power_step: float = 0.5, graph: bool = True, filename: str = None,
+                       save: bool = True, verbose: bool = True, reps: int = 1, file_format: str = ".txt"):
+        """
+        Sweeps at coarse_res and refines the step size only where it is needed, replacing a coarse sweep followed by
+        get_minima and resonance_finding.
+
+        After each coarse point is measured the interval to either side of the previous point is refined by bisection
+        if the mean power changes by more than max_power_step dB across it, or if either end is more than dip_depth
+        dB below the baseline (the median of the coarse points so far). Bisection stops when the step reaches
+        target_res, so flat regions cost only the coarse points and dips are resolved to target_res while the
+        coarse scan is still running.
+
+        Arguments:
+        coarse_res: step of the coarse scan in nm
+        target_res: smallest step in nm to refine to, at least the laser resolution
+        dip_depth: depth in dB below the baseline which counts as a dip
+        max_power_step: change in mean power in dB between neighbouring points which triggers refinement
+        Remaining arguments are as perform_wavelength_sweep
+
+        Returns:
+        wavelengths: sorted array of every wavelength measured
+        power_readings: array of dim((reps, len(wavelengths))) of power readings from the power meter
 
-                if save:
-                    f.write(str(wavelength))
-                    for j in range(reps):
-                        f.write(", " + str(power_readings[j, i]))
-                    f.write("\n")
+        Rows are saved in the order they are measured, so the saved file is not sorted by wavelength.
+        Save file naming format:
+        {dd-mm-yyyy_hh_mm}_adaptive_sweep_
+        samples_{power meter averages over samples}_
+        sensitivity_{power meter wavelength setting}_
+        {laser}_{start wavelength, 0dp}_{end wavelength, 0dp}_{coarse steps}_
+        {filename}{file_format}
+        """
+        if target_res < self.laser.resolution:
+            raise ValueError(
+                f"Wavelength increase of {target_res} nm is below laser resolution")
 
+        start_time = datetime.datetime.now().strftime("%d-%m-%Y_%H-%M")
+        self.timings = PhaseTimer()
+        coarse_range = np.arange(wavelength_start, wavelength_end + coarse_res, coarse_res)
+        readings = {}  # wavelength: array of reps readings
+
+        savefile_name = fr"adaptive_sweep_samples_{str(self.power_meter.get_average())}" + \
+                        fr"_sensitivity_{str(int(self.power_meter.get_wavelength()))}_" + \
+                        fr"{self.laser.name}_{round(wavelength_start)}_{round(wavelength_end)}_{len(coarse_range)}" \
+                        fr"{'_' + filename if filename else ''}"
+        metadata = {"kind": "adaptive_sweep", "laser": self.laser.name, "averages": self.power_meter.get_average(),
+                    "sensitivity": self.power_meter.get_wavelength(), "start": wavelength_start,
+                    "stop": wavelength_end, "res": target_res, "coarse_res": coarse_res, "reps": reps,
+                    "label": filename or ""}
+
+        monitor = SweepMonitor(len(coarse_range), title=filename or "") if verbose else None
+        with open_time_stamped_file(savefile_name, start_time, graph, save, file_format, metadata) as f, \
+                sweep_writer(f, reps, metadata) as writer, (monitor or contextlib.nullcontext()):
+
+            def measure(wavelength):
+                # Round to the laser resolution so bisection can't ask for a wavelength the laser can't set
+                wavelength = round(round(wavelength / self.laser.resolution) * self.laser.resolution, 6)
+                if wavelength not in readings:
+                    readings[wavelength] = self._measure_point(wavelength, reps)
+                    with self.timings.phase("write"):
+                        writer.append(wavelength, readings[wavelength])
+                return wavelength
+
+            def needs_refining(lower, upper, baseline):
+                lower_power, upper_power = readings[lower].mean(), readings[upper].mean()
+                return abs(upper_power - lower_power) > max_power_step or \
+                    min(lower_power, upper_power) < baseline - dip_depth
+
+            def refine(lower, upper, baseline):
+                # Intervals are refined depth first so the laser only makes small steps back and forth
+                if upper - lower <= target_res * 1.5 or not needs_refining(lower, upper, baseline):
+                    return
+                middle = measure((lower + upper) / 2)
+                if middle in (lower, upper):
+                    return
+                refine(lower, middle, baseline)
+                refine(middle, upper, baseline)
+
+            coarse = []
+            for wavelength in coarse_range:
+                coarse.append(measure(wavelength))
+                if monitor is not None:
+                    with self.timings.phase("plot"):
+                        monitor.put(coarse[-1], readings[coarse[-1]])
+                if len(coarse) < 3:
+                    continue
+                baseline = np.median([readings[point].mean() for point in coarse])
+                refine(coarse[-3], coarse[-2], baseline)
+                refine(coarse[-2], coarse[-1], baseline)
+
+        self.timings.stop()
+        wavelengths = np.array(sorted(readings))
+        power_readings = np.array([readings[wavelength] for wavelength in wavelengths]).T
         if verbose:
-            print(f"Sweep completed")
+            print(f"Sweep completed: {len(wavelengths)} points measured, "
+                  f"{len(np.arange(wavelength_start, wavelength_end + target_res, target_res))} at a fixed target_res")
 
-        return power_readings
+        return wavelengths, power_readings
 
+    @laser_control
     def resonance_finding(self, resonance_rough, width: float = 0.15, graph: bool = True, res: float = 0.002,
-                          filename: str = None, reps: int = 10, verbose: bool = True, save: bool = True):
+                          filename: str = None, reps: int = 10, verbose: bool = True, save: bool = True,
+                          file_format: str = ".txt", retry: RetryPolicy = None, checkpoint=None,
+                          averaging: AdaptiveAveraging = None):
         """
         Given a list of points that resonances are roughly supposed to be, do a scan to get the actual resonance.
         Saves the data by default.
 
+        The windows are planned by plan_resonance_windows: overlapping windows are merged so shared points are only
+        measured once, and they are swept in one pass across the range from the end nearest the laser. The laser is
+        left on from the first window to the last.
+
         Arguments:
         resonance_rough: list of points where the resonances occur. Obtain from a coarse scan. Try to centre
         width: float in nm, determines the scan range around the points that we will do. Default 0.15 from past data
         graph: bool, if True, plot final graph
         verbose: bool, if True, prints data as it is collected
         reps: no. of data readings
+        file_format: ".txt" to save as text or ".npy" to save as binary with the parameters in a .json alongside
+        retry: RetryPolicy for points which raise a transient error, see perform_wavelength_sweep
+        checkpoint: path of a checkpoint file. If it holds the progress of this search the search carries on from the
+        last point saved, partway through a window if need be, otherwise progress is saved to it after each window
+        averaging: AdaptiveAveraging to read each point until its standard error reaches a target instead of taking
+        reps readings, see perform_wavelength_sweep
+
+        Rows are saved in the order they are measured, so windows swept downwards are saved in descending wavelength
         """
+        if res < self.laser.resolution:
+            raise ValueError(
+                f"Wavelength increase of {res} nm is below laser resolution")
+
+        if averaging is not None:
+            reps = 1
+
         start_time = datetime.datetime.now().strftime("%d-%m-%Y_%H-%M")
         savefile_name = fr"resonance_finding_samples_{str(self.power_meter.get_average())}" +\
             fr"_sensitivity_{str(int(self.power_meter.get_wavelength()))}_" +\
             fr"{self.laser.name}_{str(len(resonance_rough))}{'_'+filename if filename else ''}"
 
-        # TODO: Saving only occurs after every sweep, not every reading in this function.
-        with open_time_stamped_file(savefile_name, start_time, graph, save) as f:
-            # write the header
-            f.write("wavelength_nm ")
-            for j in range(reps):
-                f.write(f",power_reading_{str(j)}_dbm ")
-            f.write("\n")
-
-            for i, wavelength in enumerate(resonance_rough):
-                scan_range = np.arange(
-                    wavelength-width, wavelength+width+res, res)
-                power_readings = self.perform_wavelength_sweep(wavelength-width, wavelength+width+res, res, graph=False,
-                                                               save=False, reps=reps)
-                if save:
-                    for j in range(len(power_readings)):
-                        f.write(str(scan_range[j]))
-                        for jj in range(reps):
-                            f.write(", " + str(power_readings[jj, j]))
-                        f.write("\n")
-
-                if verbose:
-                    print(
-                        f"Resonance {i+1} of {len(resonance_rough)} Wavelength {wavelength}")
-                    print("----------------------")
-
+        self.timings = PhaseTimer()
+        self.skipped_points = []
+        # Readings from every window are streamed into the same file as they are taken
+        metadata = {"kind": "resonance_finding", "laser": self.laser.name,
+                    "averages": self.power_meter.get_average(), "sensitivity": self.power_meter.get_wavelength(),
+                    "resonances": [float(wavelength) for wavelength in resonance_rough], "width": width, "res": res, "reps": reps,
+                    "label": filename or ""}
+        if averaging is not None:
+            metadata["averaging"] = averaging.describe()
+
+        path, rows = None, 0
+        # The windows are ordered from where the laser starts, which has to be the same when resuming
+        laser_wavelength = self.laser.get_wavelength()
+        if checkpoint is not None:
+            if not save:
+                raise ValueError("Only sweeps which are saved can be checkpointed")
+            checkpoint = SweepCheckpoint.open(checkpoint, {
+                "kind": "resonance_finding", "laser": self.laser.name, "resonances": metadata["resonances"],
+                "width": width, "res": res, "reps": reps, "file_format": file_format,
+                "averaging": None if averaging is None else averaging.describe()})
+            if checkpoint.resuming:
+                path = checkpoint.file
+                self._restore_settings(checkpoint.settings)
+                self.skipped_points = list(checkpoint.skipped)
+                laser_wavelength = checkpoint.settings.get("wavelength", laser_wavelength)
+                rows = recover_sweep_file(path)
+
+        windows = plan_resonance_windows(resonance_rough, width, res, laser_wavelength)
+        metadata["windows"] = [[float(min(points)), float(max(points))] for points in windows]
+        n_points = sum(len(points) for points in windows)
+        if verbose:
+            print("-----Conducting resonance finding-----")
+            print(f"{len(resonance_rough)} resonances in {len(windows)} windows, {n_points} points")
+            if path is not None:
+                print(f"Resuming from point {rows} of {n_points}, saving to {path}")
+
+        monitor = SweepMonitor(n_points - rows, title=filename or "") if verbose else None
+        settle_times, samples, standard_errors = [], [], []
+        with open_time_stamped_file(savefile_name, start_time, graph, save, file_format, metadata, path) as f, \
+                sweep_writer(f, reps, metadata, rows) as writer, (monitor or contextlib.nullcontext()):
+            if checkpoint is not None and not checkpoint.resuming:
+                checkpoint.update(file=f.name, settings={**self._settings(), "wavelength": laser_wavelength})
+            for i, points in enumerate(windows):
+                if rows >= len(points):
+                    rows -= len(points)
+                    continue
+                _, window_settle_times, window_samples, window_standard_errors = self._sweep_points(
+                    points, reps, writer, skip=rows, monitor=monitor, retry=retry, averaging=averaging)
+                settle_times.append(window_settle_times)
+                samples.append(window_samples)
+                standard_errors.append(window_standard_errors)
+                rows = 0
+                if checkpoint is not None:
+                    # Make the window durable before recording it as done
+                    writer.flush()
+                    checkpoint.update(completed=writer.rows_written, window=i + 1, skipped=self.skipped_points)
+
+            self.settle_times = np.concatenate(settle_times) if settle_times else np.array([])
+            self.samples = np.concatenate(samples) if samples else np.array([], dtype=int)
+            self.standard_errors = np.concatenate(standard_errors) if standard_errors else np.array([])
+            if averaging is not None:
+                # Saved with the file when it is closed. Only the windows measured in this run when resuming
+                metadata["samples"] = self.samples.tolist()
+                metadata["standard_errors"] = self.standard_errors.tolist()
+
+        if checkpoint is not None:
+            checkpoint.remove()
+        self.timings.stop()
         if verbose:
             print(f"Sweep completed")
+            print(f"Mean settle time {np.nanmean(self.settle_times):.3f}s")
 
         return True
 
+    def write_timings(self, path, trace: bool = False):
+        """
+        Save the phase timings of the last sweep and the command statistics of both instruments.
+
+        Arguments:
+        path: file to save to
+        trace: if True, save the most recent phases and commands as a Chrome trace file (open in chrome://tracing or
+        https://ui.perfetto.dev) instead of a JSON summary
+        """
+        stats = [instrument.stats for instrument in (self.laser, self.power_meter) if hasattr(instrument, "stats")]
+        (write_trace if trace else write_summary)(path, self.timings, stats)
+
 
 if __name__ == "__main__":
     from core.utils import MockInstrument
@@ -0,0 +1,174 @@
+""" This file is for fitting Lorentzian lineshapes to the resonance dips in sweeps """
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.signal import find_peaks, peak_widths
+
+from core.analysis import Sweep
+
+
+def lorentzian_dip(wavelength, center, fwhm, depth, baseline):
+    """ Lorentzian dip of a ring resonance in linear power. Broadcasts over all arguments """
+    half_width_squared = (fwhm / 2) ** 2
+    return baseline - depth * half_width_squared / ((wavelength - center) ** 2 + half_width_squared)
+
+
+def _jacobian(wavelength, center, fwhm, depth):
+    """ Derivatives of lorentzian_dip with respect to (center, fwhm, depth, baseline), dim((..., 4)) """
+    detuning = wavelength - center
+    half_width_squared = (fwhm / 2) ** 2
+    denominator = detuning ** 2 + half_width_squared
+    return np.stack((-depth * half_width_squared * 2 * detuning / denominator ** 2,
+                     -depth * detuning ** 2 / denominator ** 2 * fwhm / 2,
+                     -half_width_squared / denominator,
+                     np.ones_like(detuning)), axis=-1)
+
+
+def fit_lorentzians(wavelengths, power, initial, iterations: int = 100, tolerance: float = 1e-10):
+    """
+    Fit lorentzian_dip to many dips at once with a Levenberg-Marquardt fit vectorised over the dips.
+
+    Arguments:
+    wavelengths: array of dim((dips, points)), padded with NaN where a dip has fewer points
+    power: array of dim((dips, points)) of linear power, NaN padded in the same places
+    initial: array of dim((dips, 4)) of initial (center, fwhm, depth, baseline)
+
+    Returns:
+    parameters: array of dim((dips, 4)) of fitted (center, fwhm, depth, baseline)
+    converged: boolean array of whether each fit converged within iterations
+    """
+    weights = ~(np.isnan(wavelengths) | np.isnan(power))
+    wavelengths, power = np.where(weights, wavelengths, 0), np.where(weights, power, 0)
+    parameters = np.array(initial, dtype=float)
+    damping = np.full(len(parameters), 1e-3)
+    converged = np.zeros(len(parameters), dtype=bool)
+
+    def cost(p):
+        residuals = (lorentzian_dip(wavelengths, *p.T[:, :, np.newaxis]) - power) * weights
+        return residuals, (residuals ** 2).sum(axis=1)
+
+    residuals, current_cost = cost(parameters)
+    for _ in range(iterations):
+        jacobian = _jacobian(wavelengths, *parameters.T[:3, :, np.newaxis]) * weights[:, :, np.newaxis]
+        normal = np.einsum("dpi,dpj->dij", jacobian, jacobian)
+        gradient = np.einsum("dpi,dp->di", jacobian, residuals)
+        diagonal = np.einsum("dii->di", normal)
+        damped = normal + damping[:, np.newaxis, np.newaxis] * np.eye(4) * diagonal[:, np.newaxis, :]
+        # pinv rather than solve so one degenerate window doesn't stop the others being fitted
+        step = np.einsum("dij,dj->di", np.linalg.pinv(damped), -gradient)
+        step[converged] = 0
+
+        trial = parameters + step
+        trial[:, 1] = np.abs(trial[:, 1])
+        trial_residuals, trial_cost = cost(trial)
+        improved = trial_cost < current_cost
+        converged |= improved & (current_cost - trial_cost <= tolerance * current_cost)
+
+        parameters[improved] = trial[improved]
+        residuals[improved] = trial_residuals[improved]
+        current_cost[improved] = trial_cost[improved]
+        damping = np.where(improved, damping / 3, damping * 2)
+        if converged.all():
+            break
+
+    return parameters, converged
+
+
+def _windows(wavelengths, values, centers, half_widths):
+    """ Cut a window of half_widths around each center out of sorted wavelengths, padded with NaN """
+    starts = np.searchsorted(wavelengths, centers - half_widths, side="left")
+    ends = np.searchsorted(wavelengths, centers + half_widths, side="right")
+    length = int((ends - starts).max()) if len(starts) else 0
+    indices = starts[:, np.newaxis] + np.arange(length)
+    valid = indices < ends[:, np.newaxis]
+    indices = np.minimum(indices, len(wavelengths) - 1)
+    return np.where(valid, wavelengths[indices], np.nan), np.where(valid, values[indices], np.nan)
+
+
+def fit_resonances(wavelengths, power_readings, prominence: float = 2, distance: int = 1,
+                   half_width: float = None):
+    """
+    Detect the resonance dips in a sweep and fit a Lorentzian to every one of them at once.
+
+    Arguments:
+    wavelengths: array of wavelengths in nm
+    power_readings: array of dim((reps, steps)) or dim((steps)) of power readings in dBm
+    prominence: minimum depth in dB of a dip
+    distance: minimum number of points between dips
+    half_width: half width in nm of the window fitted around each dip. Defaults to five times the estimated FWHM,
+    limited to half of the distance to the next dip
+
+    Returns:
+    DataFrame with a row per dip of center (nm), fwhm (nm), q_factor, extinction_ratio (dB), fsr (nm, the mean
+    distance to the neighbouring dips), depth and baseline (mW) and whether the fit converged
+    """
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    mean_power = np.atleast_2d(power_readings).mean(axis=0)
+    order = np.argsort(wavelengths, kind="stable")
+    wavelengths, mean_power = wavelengths[order], mean_power[order]
+    linear_power = 10 ** (mean_power / 10)
+
+    minima, _ = find_peaks(-mean_power, prominence=prominence, distance=distance)
+    columns = ["center", "fwhm", "q_factor", "extinction_ratio", "fsr", "depth", "baseline", "converged"]
+    if len(minima) == 0:
+        return pd.DataFrame(columns=columns)
+
+    # Initial guesses from the width at half the prominence of each dip
+    _, _, left, right = peak_widths(-mean_power, minima, rel_height=0.5)
+    points = np.arange(len(wavelengths))
+    fwhm_guess = np.maximum(np.interp(right, points, wavelengths) - np.interp(left, points, wavelengths),
+                            np.gradient(wavelengths)[minima])
+    centers = wavelengths[minima]
+    if half_width is None:
+        spacing = np.diff(centers)
+        neighbour = np.minimum(np.append(spacing, np.inf), np.insert(spacing, 0, np.inf))
+        half_widths = np.minimum(5 * fwhm_guess, neighbour / 2)
+    else:
+        half_widths = np.full(len(minima), half_width)
+
+    window_wavelengths, window_power = _windows(wavelengths, linear_power, centers, half_widths)
+    baseline_guess = np.nanmax(window_power, axis=1)
+    scale = baseline_guess[:, np.newaxis]
+    initial = np.column_stack((centers, fwhm_guess, 1 - linear_power[minima] / baseline_guess,
+                               np.ones(len(minima))))
+    parameters, converged = fit_lorentzians(window_wavelengths, window_power / scale, initial)
+
+    center, fwhm = parameters[:, 0], parameters[:, 1]
+    depth, baseline = parameters[:, 2] * baseline_guess, parameters[:, 3] * baseline_guess
+    with np.errstate(divide="ignore", invalid="ignore"):
+        extinction_ratio = 10 * np.log10(baseline / np.clip(baseline - depth, 0, None))
+    fsr = np.gradient(center) if len(center) > 1 else np.full(len(center), np.nan)
+
+    return pd.DataFrame({"center": center, "fwhm": fwhm, "q_factor": center / fwhm,
+                         "extinction_ratio": extinction_ratio, "fsr": fsr, "depth": depth, "baseline": baseline,
+                         "converged": converged}, columns=columns)
+
+
+def _fit_sweep(sweep, kwargs):
+    sweep = sweep if isinstance(sweep, Sweep) else Sweep(sweep)
+    return fit_resonances(np.asarray(sweep.wavelengths), np.asarray(sweep.readings).T, **kwargs)
+
+
+def fit_sweeps(sweeps, processes: int = None, **kwargs):
+    """
+    Fit the resonances of many sweeps, optionally spread over a pool of processes.
+
+    Arguments:
+    sweeps: iterable of Sweep objects or paths, e.g. a SweepStack
+    processes: number of worker processes, or None to fit in this process
+    kwargs: passed to fit_resonances
+
+    Returns:
+    DataFrame of every resonance, as fit_resonances, with the sweep path in the "sweep" column
+    """
+    paths = [sweep.path if isinstance(sweep, Sweep) else sweep for sweep in sweeps]
+    if processes is None:
+        results = [_fit_sweep(path, kwargs) for path in paths]
+    else:
+        with ProcessPoolExecutor(processes) as executor:
+            results = list(executor.map(_fit_sweep, paths, [kwargs] * len(paths)))
+
+    for path, result in zip(paths, results):
+        result.insert(0, "sweep", str(path))
+    return pd.concat(results, ignore_index=True) if results else pd.DataFrame()
@@ -0,0 +1,202 @@
+""" This file is for recording where the time goes during a sweep: every command sent to each instrument and the
+phases (set, settle, read, write, plot) of every point
+
+laser.stats.report()                   # commands sent to the laser, slowest first
+setup.timings.report()                 # time spent in each phase of the last sweep
+setup.write_timings("sweep_trace.json", trace=True)  # open in chrome://tracing or ui.perfetto.dev
+"""
+import collections
+import contextlib
+import json
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from pyvisa.constants import StatusCode
+from pyvisa.errors import VisaIOError
+
+# Upper edges in seconds of the latency histogram bins, four per decade from 10us to 100s
+LATENCY_BINS = np.logspace(-5, 2, 29)
+# Number of the most recent events kept for a trace
+TRACE_LENGTH = 100000
+
+
+def command_name(message: str):
+    """ The command of a message without its arguments, e.g. ':SOURCE1:CHAN1:WAV 1550 NM' -> ':SOURCE1:CHAN1:WAV' and
+    'L=1550' -> 'L='. Runs of the same command in a compound message are counted, e.g. ':READ? x10' """
+    names = []
+    for command in message.split(";"):
+        command = command.strip()
+        name = command.split("=")[0] + "=" if "=" in command else command.split(" ")[0]
+        if names and names[-1][0] == name:
+            names[-1][1] += 1
+        else:
+            names.append([name, 1])
+    return ";".join(name if count == 1 else f"{name} x{count}" for name, count in names)
+
+
+class CommandStats:
+    """
+    Count, latency histogram, timeouts, errors and retries of every command sent to an instrument. Every
+    InstrumentManager has one as self.stats which _send_message records into.
+
+    Arguments:
+    name: name of the instrument, used in reports and traces
+    """
+
+    def __init__(self, name: str = ""):
+        self.name = name
+        self.commands = {}
+        self.events = collections.deque(maxlen=TRACE_LENGTH)
+        self._lock = threading.Lock()
+
+    def _command(self, name: str):
+        if name not in self.commands:
+            self.commands[name] = {"count": 0, "total": 0.0, "min": np.inf, "max": 0.0, "timeouts": 0, "errors": 0,
+                                   "retries": 0, "histogram": np.zeros(len(LATENCY_BINS) + 1, dtype=int)}
+        return self.commands[name]
+
+    @contextlib.contextmanager
+    def timed(self, message: str):
+        """ Time sending message to the instrument. VISA timeouts and other errors raised in the block are counted """
+        start = time.perf_counter()
+        try:
+            yield
+        except VisaIOError as e:
+            self.record(message, start, time.perf_counter(),
+                        "timeout" if e.error_code == StatusCode.error_timeout else "error")
+            raise
+        except Exception:
+            self.record(message, start, time.perf_counter(), "error")
+            raise
+        self.record(message, start, time.perf_counter())
+
+    def record(self, message: str, start: float, end: float, error: str = None):
+        """ Record a message sent between the perf_counter() times start and end. error is 'timeout' or 'error' """
+        name = command_name(message)
+        seconds = end - start
+        with self._lock:
+            command = self._command(name)
+            command["count"] += 1
+            command["total"] += seconds
+            command["min"] = min(command["min"], seconds)
+            command["max"] = max(command["max"], seconds)
+            command["histogram"][np.searchsorted(LATENCY_BINS, seconds)] += 1
+            if error is not None:
+                command[f"{error}s"] += 1
+            self.events.append((name, start, seconds, threading.get_ident()))
+
+    def record_retry(self, message: str):
+        with self._lock:
+            self._command(command_name(message))["retries"] += 1
+
+    def reset(self):
+        with self._lock:
+            self.commands = {}
+            self.events.clear()
+
+    def summary(self):
+        """ List of a dict per command of its count, total, mean, min, max and median (estimated from the histogram)
+        latency in seconds, timeouts, errors and retries, slowest in total first """
+        with self._lock:
+            commands = {name: {**command, "histogram": command["histogram"].copy()}
+                        for name, command in self.commands.items()}
+        rows = []
+        for name, command in commands.items():
+            cumulative = np.cumsum(command["histogram"])
+            median_bin = int(np.searchsorted(cumulative, cumulative[-1] / 2))
+            rows.append({"instrument": self.name, "command": name, "count": command["count"],
+                         "total": command["total"], "mean": command["total"] / command["count"],
+                         "min": command["min"], "max": command["max"],
+                         "median": float(LATENCY_BINS[min(median_bin, len(LATENCY_BINS) - 1)]),
+                         "timeouts": command["timeouts"], "errors": command["errors"],
+                         "retries": command["retries"], "histogram": command["histogram"].tolist()})
+        return sorted(rows, key=lambda row: row["total"], reverse=True)
+
+    def report(self):
+        lines = [f"{self.name}: {'command':<40} {'count':>8} {'total s':>9} {'mean ms':>9} {'max ms':>9} "
+                 f"{'timeouts':>8} {'errors':>6} {'retries':>7}"]
+        for row in self.summary():
+            lines.append(f"{'':<{len(self.name) + 2}}{row['command'][:40]:<40} {row['count']:>8} {row['total']:>9.3f} "
+                         f"{1e3 * row['mean']:>9.3f} {1e3 * row['max']:>9.3f} {row['timeouts']:>8} "
+                         f"{row['errors']:>6} {row['retries']:>7}")
+        return "\n".join(lines)
+
+
+class PhaseTimer:
+    """ Total time spent in each phase of a sweep, e.g. set, settle, read, write and plot
+
+    with timings.phase("settle"):
+        laser.wait_steady_state()
+    """
+
+    def __init__(self):
+        self.totals = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+        self.events = collections.deque(maxlen=TRACE_LENGTH)
+        self.start = time.perf_counter()
+        self.end = None
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter())
+
+    def add(self, name: str, start: float, end: float):
+        self.totals[name] += end - start
+        self.counts[name] += 1
+        self.events.append((name, start, end - start, threading.get_ident()))
+
+    def stop(self):
+        self.end = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return (time.perf_counter() if self.end is None else self.end) - self.start
+
+    def summary(self):
+        """ Dict of each phase's count, total and mean seconds and the fraction of the elapsed time spent in it """
+        elapsed = self.elapsed
+        return {name: {"count": self.counts[name], "total": total, "mean": total / self.counts[name],
+                       "fraction": total / elapsed if elapsed else np.nan}
+                for name, total in self.totals.items()}
+
+    def report(self):
+        summary = self.summary()
+        lines = [f"{'phase':<10} {'count':>8} {'total s':>9} {'mean ms':>9} {'% time':>7}"]
+        for name, phase in summary.items():
+            lines.append(f"{name:<10} {phase['count']:>8} {phase['total']:>9.3f} {1e3 * phase['mean']:>9.3f} "
+                         f"{100 * phase['fraction']:>7.1f}")
+        lines.append(f"{'elapsed':<10} {'':>8} {self.elapsed:>9.3f}")
+        return "\n".join(lines)
+
+
+def write_summary(path, timings: PhaseTimer = None, stats=()):
+    """ Save the phase timings and the command statistics of each of stats (CommandStats) as JSON """
+    summary = {"elapsed": None if timings is None else timings.elapsed,
+               "phases": {} if timings is None else timings.summary(),
+               "commands": [row for instrument in stats for row in instrument.summary()],
+               "latency_bins": LATENCY_BINS.tolist()}
+    with open(Path(path), "w") as f:
+        json.dump(summary, f, indent=2, default=float)
+
+
+def write_trace(path, timings: PhaseTimer = None, stats=()):
+    """ Save the most recent phases and commands as a Chrome trace event file, which can be opened in
+    chrome://tracing or https://ui.perfetto.dev. Phases and each instrument are shown as separate processes """
+    sources = ([("sweep", timings.events)] if timings is not None else []) + \
+        [(instrument.name or f"instrument {i}", instrument.events) for i, instrument in enumerate(stats)]
+    origin = min((events[0][1] for _, events in sources if events), default=0)
+
+    trace_events = []
+    for pid, (source, events) in enumerate(sources):
+        trace_events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": source}})
+        for name, start, seconds, thread in list(events):
+            trace_events.append({"name": name, "ph": "X", "pid": pid, "tid": thread,
+                                 "ts": 1e6 * (start - origin), "dur": 1e6 * seconds})
+    with open(Path(path), "w") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
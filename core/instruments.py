@@ -1,39 +1,244 @@
 """ This file is for functions and classes used to connect to the instruments """
 
-from pyvisa import ResourceManager
 from pyvisa.resources import TCPIPInstrument, USBInstrument, SerialInstrument
 from pyvisa.errors import VisaIOError
+from concurrent.futures import ThreadPoolExecutor, Future
+import threading
 import time
+import warnings
 import numpy as np
 
 from core.utils import unit_conversion
+from core.settling import LockSettling, LearnedSettling
+from core.instrumentation import CommandStats
 
-rm = ResourceManager()
+_resource_manager = None
+
+
+def get_resource_manager():
+    """ The ResourceManager shared by every instrument. It is created on first use so that importing this module
+    doesn't load the VISA backend """
+    global _resource_manager
+    if _resource_manager is None:
+        from pyvisa import ResourceManager
+        _resource_manager = ResourceManager()
+    return _resource_manager
+
+
+def __getattr__(name):
+    # Kept so that core.instruments.rm still works
+    if name == "rm":
+        return get_resource_manager()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class CommandBatch:
+    """ Context manager which accumulates writes and queries and sends them to the instrument in one transaction when
+    the block exits. Replies to the queries are in self.replies in the order the queries were made.
+
+    with laser.batch() as batch:
+        batch.write(":SOURCE1:CHAN1:WAV 1550 NM")
+        batch.query(":SOURCE1:CHAN1:WAV? LOCK")
+    locked = batch.replies[0]
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.messages = []
+        self.replies = []
+
+    def write(self, message: str):
+        self.messages.append((message, False))
+
+    def query(self, message: str):
+        self.messages.append((message, True))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Nothing is sent if an error occurred while building the batch
+        if exc_type is None:
+            self.replies = self.manager._send_batch(self.messages)
+        self.messages = []
 
 
 class InstrumentManager:
     """ Wrapper class for managing instruments """
 
+    # Set to False on instruments whose MIN/MAX values are hardcoded rather than queried
+    limits_from_hardware = True
+    # Set to False on instruments which can't take several ';' separated commands in one message
+    supports_batching = True
+    # pyvisa resource class the instrument is expected to be
+    resource_type = None
+    # Every this many reads of a cached setting, the instrument is queried to check the cache is still right
+    consistency_interval = 100
+
     def __init__(self, resource_name: str):
-        self.instrument = rm.open_resource(resource_name)
+        self.stats = CommandStats(type(self).__name__)  # count and latency of every command sent
+        self.resource_name = resource_name
+        self.instrument = self._open_resource(resource_name)
+        self._limits = {}
+        self._state = {}  # quantity: (unit, value) of every setting written to or read from the instrument
+        self._state_queries = {}  # quantity: function querying the setting from the instrument
+        self._state_reads = {}
+        self.inconsistencies = []  # (quantity, cached, actual) of every setting found to have changed behind our back
+        self.round_trips_saved = 0
+        self._executor = None
+
+    def _open_resource(self, resource_name: str):
+        """ Open the instrument. Overridden by the simulated instruments in core.simulation """
+        instrument = get_resource_manager().open_resource(resource_name)
+        if self.resource_type is not None and not isinstance(instrument, self.resource_type):
+            raise TypeError(
+                f"The instrument with name '{resource_name}' is not of type {self.resource_type}.")
+        return instrument
+
+    def submit(self, method: str, *args, **kwargs) -> Future:
+        """ Call a method of this instrument on its own worker thread and return a Future of the result.
+
+        Every instrument has a single worker so commands submitted from different threads are still sent in order,
+        while commands to different instruments can overlap. Don't call methods directly while submitted calls to the
+        same instrument are outstanding.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=type(self).__name__)
+        return self._executor.submit(getattr(self, method), *args, **kwargs)
+
+    async def call_async(self, method: str, *args, **kwargs):
+        """ Async variant of calling a method, e.g. await laser.call_async("set_wavelength", 1550) """
+        import asyncio
+        return await asyncio.wrap_future(self.submit(method, *args, **kwargs))
+
+    def get_limits(self, quantity: str):
+        """ Return the (min, max) of a quantity, e.g. 'wavelength', in its current unit.
+
+        Limits are static for a given unit so they are cached after the first query. The cache is keyed on the unit
+        so changing e.g. wavelength_unit will cause a fresh MIN/MAX query.
+        """
+        key = (quantity, getattr(self, f"{quantity}_unit"))
+        if key in self._limits:
+            if self.limits_from_hardware:
+                self.round_trips_saved += 2
+            return self._limits[key]
+
+        getter = getattr(self, f"get_{quantity}")
+        self._limits[key] = (getter("MIN"), getter("MAX"))
+        return self._limits[key]
+
+    def refresh_limits(self, *quantities: str):
+        """ Clear the limits cache and query the limits of the given quantities again """
+        self._limits.clear()
+        for quantity in quantities:
+            self.get_limits(quantity)
+
+    def _check_limits(self, quantity: str, value: float):
+        """ Raise a ValueError if value is outside the cached limits of quantity """
+        unit = getattr(self, f"{quantity}_unit")
+        minimum, maximum = self.get_limits(quantity)
+        if value < minimum:
+            raise ValueError(f"{quantity.capitalize()} '{value} {unit}' "
+                             f"is below laser minimum '{minimum} {unit}'")
+        elif value > maximum:
+            raise ValueError(f"{quantity.capitalize()} '{value} {unit}' "
+                             f"is above laser maximum '{maximum} {unit}'")
+
+    def _remember(self, quantity: str, value):
+        """ Record a setting which has just been written to the instrument """
+        self._state[quantity] = (getattr(self, f"{quantity}_unit", None), value)
+
+    def _forget(self, *quantities: str):
+        for quantity in quantities:
+            self._state.pop(quantity, None)
+
+    def _recall(self, quantity: str, query, force: bool = False):
+        """
+        Return a setting from the state cache rather than querying the instrument.
+
+        The instrument is queried with query() if the setting isn't known in its current unit, if force, or every
+        consistency_interval reads as a check. If the instrument disagrees with the cache the instrument's value is
+        used and the difference is recorded in self.inconsistencies.
+        """
+        self._state_queries[quantity] = query
+        unit = getattr(self, f"{quantity}_unit", None)
+        cached = self._state.get(quantity)
+        if cached is not None and cached[0] == unit and not force:
+            self._state_reads[quantity] = self._state_reads.get(quantity, 0) + 1
+            if self._state_reads[quantity] % self.consistency_interval:
+                self.round_trips_saved += 1
+                return cached[1]
+
+        value = query()
+        if cached is not None and cached[0] == unit and not _same_setting(cached[1], value):
+            self.inconsistencies.append((quantity, cached[1], value))
+            warnings.warn(f"{quantity.capitalize()} of {type(self).__name__} was {value} but was expected to be "
+                          f"{cached[1]}. Has it been changed from elsewhere?")
+        self._state[quantity] = (unit, value)
+        return value
+
+    def check_consistency(self):
+        """ Query every cached setting from the instrument and return a list of (quantity, cached, actual) of those
+        which differ. The cache is updated to the instrument's values """
+        found = len(self.inconsistencies)
+        for quantity, query in self._state_queries.items():
+            self._recall(quantity, query, force=True)
+        return self.inconsistencies[found:]
+
+    def _forget_command(self, message: str):
+        """ Drop the cached settings which the write message changes """
+        quantities = self._command_settings.get(message.split("=")[0])
+        if quantities is None:
+            # Anything else, e.g. a change of unit, may have affected any setting
+            self._state.clear()
+        else:
+            self._forget(*quantities)
+        if message.startswith("L="):
+            self._wavelength = None
 
     def _send_message(self, message: str, read: bool = True):
         try:
-            if read:
-                return self.instrument.query(message).strip("\n")
-            else:
-                self.instrument.write(message)
+            with self.stats.timed(message):
+                if read:
+                    return self.instrument.query(message).strip("\n")
+                else:
+                    self.instrument.write(message)
         except VisaIOError as e:
             self._check_error()
             raise IOError(e)
 
+    def batch(self):
+        return CommandBatch(self)
+
+    def _send_batch(self, messages: list):
+        """ Send a list of (message, read) pairs as one SCPI compound message and return the list of query replies """
+        if not messages:
+            return []
+        if not self.supports_batching:
+            replies = [self._send_message(message, read=read) for message, read in messages]
+            return [reply for reply, (_, read) in zip(replies, messages) if read]
+
+        # Every command is made absolute so the header path of the previous command doesn't apply to it
+        compound = ";".join(message if message.startswith((":", "*")) else ":" + message
+                            for message, _ in messages)
+        n_queries = sum(read for _, read in messages)
+        if n_queries == 0:
+            self._send_message(compound, read=False)
+            return []
+
+        replies = self._send_message(compound).split(";")
+        if len(replies) != n_queries:
+            raise IOError(f"Expected {n_queries} replies to '{compound}' but received {len(replies)}")
+        return [reply.strip() for reply in replies]
+
     def _check_error(self):
         """ '*ESR?' to check standard event Status Register. This will show any errors
         5: Command Error 32
         4: Execution Error 16
         3: Device dependent Error 8
         """
-        error = int(self.instrument.query("*ESR?"))
+        with self.stats.timed("*ESR?"):
+            error = int(self.instrument.query("*ESR?"))
         if error == 32:
             raise IOError("Command Error")
         elif error == 16:
@@ -66,24 +271,24 @@ class QuantifiManager(InstrumentManager):
         Tunics Plus laser SCPI commands can be found in the docs folder.
     """
 
+    resource_type = TCPIPInstrument
+
     def __init__(self, resource_name: str = 'TCPIP0::192.168.101.201::inst0::INSTR', power: float = 7.5):
         super().__init__(resource_name)
 
-        if not isinstance(self.instrument, TCPIPInstrument):
-            raise TypeError(
-                f"The instrument with name '{resource_name}' is not of type {TCPIPInstrument}.")
-
         self.wavelength_unit = "NM"
         self.frequency_unit = "THZ"
         self.power_unit = "DBM"
         self.resolution = 0.001  # WARNING: This is in nm and doesn't consider wavelength_unit
         self.max_wait_time = 25  # supposed to calibrate in <25s for quantifi laser
         self.name = "QUANTIFI"
+        self.settling = LockSettling()
 
         self.source = ":SOURCE1"
         self.output = ":OUTP1"
         self.channel = ":CHAN1"
 
+        self.refresh_limits("wavelength", "frequency", "power")
         self.set_power(power)  # default power is 10
 
     @property
@@ -95,21 +300,18 @@ class QuantifiManager(InstrumentManager):
         return self.output + self.channel
 
     def set_frequency(self, frequency: float):
-        if frequency < (min_freq := self.get_frequency("MIN")):
-            raise ValueError(f"Frequency '{frequency} {self.frequency_unit}' "
-                             f"is below laser minimum '{min_freq} {self.frequency_unit}'")
-        elif frequency > (max_freq := self.get_frequency("MAX")):
-            raise ValueError(f"Frequency '{frequency} {self.frequency_unit}' "
-                             f"is above laser maximum '{max_freq} {self.frequency_unit}'")
+        self._check_limits("frequency", frequency)
 
         self._send_message(
             f"{self.source_prefix}:FREQ {frequency} {self.frequency_unit}", read=False)
+        self._remember("frequency", frequency)
+        self._forget("wavelength")
 
     def shift_frequency(self, frequency_shift: float):
         frequency = self.get_frequency()
         self.set_frequency(frequency + frequency_shift)
 
-    def get_frequency(self, param: str = ""):
+    def get_frequency(self, param: str = "", force: bool = False):
         """ param (str):
                         MIN: Return the minimum programmable value
                         MAX: Return the maximum programmable value
@@ -119,25 +321,26 @@ class QuantifiManager(InstrumentManager):
                         LOCK: Query whether the laser is currently at the SET frequency
                         ALL: Returns all of the above parameters
         ref manual pg. 51
+        The set value is served from the state cache unless force
         """
-        return float(self._send_message(f"{self.source_prefix}:FREQ? {param}")) / unit_conversion[self.frequency_unit]
+        def query():
+            return float(self._send_message(f"{self.source_prefix}:FREQ? {param}")) / \
+                unit_conversion[self.frequency_unit]
+        return self._recall("frequency", query, force) if param in ("", "SET") else query()
 
     def set_wavelength(self, wavelength: float):
-        if wavelength < (min_wav := self.get_wavelength("MIN")):
-            raise ValueError(f"Wavelength '{wavelength} {self.wavelength_unit}' "
-                             f"is below laser minimum '{min_wav} {self.wavelength_unit}'")
-        elif wavelength > (max_wav := self.get_wavelength("MAX")):
-            raise ValueError(f"Wavelength '{wavelength} {self.wavelength_unit}' "
-                             f"is above laser maximum '{max_wav} {self.wavelength_unit}'")
+        self._check_limits("wavelength", wavelength)
 
         self._send_message(
             f"{self.source_prefix}:WAV {wavelength} {self.wavelength_unit}", read=False)
+        self._remember("wavelength", wavelength)
+        self._forget("frequency")
 
     def shift_wavelength(self, wavelength_shift: float):
         wavelength = self.get_wavelength()
         self.set_wavelength(wavelength + wavelength_shift)
 
-    def get_wavelength(self, param: str = ""):
+    def get_wavelength(self, param: str = "", force: bool = False):
         """ param (str):
                         MIN: Return the minimum programmable value
                         MAX: Return the maximum programmable value
@@ -147,41 +350,42 @@ class QuantifiManager(InstrumentManager):
                         LOCK: Query whether the laser is currently at the SET wavelength
                         ALL: Returns all of the above parameters
             ref manual pg. 51
+        The set value is served from the state cache unless force
         """
-        return float(self._send_message(f"{self.source_prefix}:WAV? {param}")) / unit_conversion[self.wavelength_unit]
+        def query():
+            return float(self._send_message(f"{self.source_prefix}:WAV? {param}")) / \
+                unit_conversion[self.wavelength_unit]
+        return self._recall("wavelength", query, force) if param in ("", "SET") else query()
 
     def set_power(self, power: float):
-        if power < (min_power := self.get_power("MIN")):
-            raise ValueError(f"Power '{power} {self.power_unit}' "
-                             f"is below laser minimum '{min_power} {self.power_unit}'")
-        elif power > (max_power := self.get_power("MAX")):
-            raise ValueError(f"Power '{power} {self.power_unit}' "
-                             f"is above laser maximum '{max_power} {self.power_unit}'")
+        self._check_limits("power", power)
 
         self._send_message(
             f"{self.source_prefix}:POW {power} {self.power_unit}", read=False)
         self._defined_power = power
+        self._remember("power", power)
 
     def check_steady_state(self, res=3):
-        return np.round(self.get_power("SET"), res) == np.round(self.get_power("ACT"), res)
+        with self.batch() as batch:
+            batch.query(f"{self.source_prefix}:POW? SET")
+            batch.query(f"{self.source_prefix}:POW? ACT")
+        set_power, actual_power = (float(reply) for reply in batch.replies)
+        return np.round(set_power, res) == np.round(actual_power, res)
+
+    def is_locked(self):
+        """ Query whether the laser is currently at the SET wavelength. ref manual pg. 51 """
+        return self._send_message(f"{self.source_prefix}:WAV? LOCK").strip().upper() in ("1", "ON", "TRUE")
 
     def wait_steady_state(self):
         """
-        Checks if laser has reached steady state every 1 second by comparing the set and current
-        powers.
+        Waits for the laser to reach steady state using the settling strategy. Returns False if the laser has not
+        settled within max_wait_time. The observed settle time is kept in self.settling.last_settle_time
         """
-        elapsed_time = 0
-        delay_time = 1
-        while elapsed_time < self.max_wait_time:
-            if self.check_steady_state():
-                return True
-            time.sleep(delay_time)
-            elapsed_time += delay_time
-
-        return False
+        return self.settling.wait(self)
 
     def shift_power(self, power_shift: float):
-        power = self.get_power()
+        # Shift from the set power rather than the actual power, which may not have settled
+        power = self.get_power("SET")
         self.set_power(power + power_shift)
 
     def get_power(self, param: str = ""):
@@ -194,16 +398,56 @@ class QuantifiManager(InstrumentManager):
                         ALL: Returns all of the above parameters
 
             ref manual pg. 50
+        Only the set value is served from the state cache as the actual value is a measurement
         """
-        return float(self._send_message(f"{self.source_prefix}:POW? {param}"))
+        def query():
+            return float(self._send_message(f"{self.source_prefix}:POW? {param}"))
+        return self._recall("power", query) if param == "SET" else query()
 
     def set_state(self, state: bool):
         self._send_message(
             f"{self.output_prefix}:STATE {'ON' if state else 'OFF'}", read=False)
+        self._remember("state", state)
 
-    def get_state(self):
-        state = self._send_message(f"{self.output_prefix}:STATE?")
-        return True if state == "ON" else False
+    def get_state(self, force: bool = False):
+        def query():
+            state = self._send_message(f"{self.output_prefix}:STATE?")
+            return True if state == "ON" else False
+        return self._recall("state", query, force)
+
+    def run_sweep(self, wavelength_start: float, wavelength_end: float, speed: float, step: float = None,
+                  stop_event: threading.Event = None):
+        """
+        Tune the laser from wavelength_start to wavelength_end at speed (wavelength_unit per second) without
+        waiting for it to settle between steps.
+
+        The Laser 1000 has no sweep or trigger subsystem so the steps are paced in software. Each wavelength write
+        is timestamped with time.perf_counter() so readings taken concurrently can be mapped back to wavelength.
+        The sweep can be cut short by setting stop_event.
+
+        Returns:
+        array of dim((steps, 2)) with columns of timestamp and wavelength
+        """
+        step = self.resolution if step is None else step
+        wavelengths = np.arange(wavelength_start, wavelength_end + step, step)
+        self._check_limits("wavelength", wavelengths.min())
+        self._check_limits("wavelength", wavelengths.max())
+
+        timestamps = np.full(len(wavelengths), np.nan)
+        start = time.perf_counter()
+        for i, wavelength in enumerate(wavelengths):
+            if stop_event is not None and stop_event.is_set():
+                break
+            if (delay := start + i * step / speed - time.perf_counter()) > 0:
+                time.sleep(delay)
+            self._send_message(
+                f"{self.source_prefix}:WAV {wavelength} {self.wavelength_unit}", read=False)
+            timestamps[i] = time.perf_counter()
+            self._remember("wavelength", wavelength)
+        self._forget("frequency")
+
+        completed = ~np.isnan(timestamps)
+        return np.column_stack((timestamps[completed], wavelengths[completed]))
 
 
 class TunicsManager(InstrumentManager):
@@ -213,39 +457,36 @@ class TunicsManager(InstrumentManager):
         Tunics Plus but the commands should be similar.
     """
 
+    limits_from_hardware = False  # MIN/MAX are hardcoded in the get_* methods
+    supports_batching = False  # Every command gets its own "> " reply so commands can't be concatenated
+    resource_type = SerialInstrument
+    max_pending = 16  # Writes sent before waiting for their acknowledgements
+    # Cached settings changed by each command, for forgetting those of writes which may not have reached the laser
+    _command_settings = {"L": ("wavelength", "frequency"), "F": ("wavelength", "frequency"), "P": ("power",),
+                         "ENABLE": ("state",), "DISABLE": ("state",)}
+
     def __init__(self, resource_name: str = 'ASRL4::INSTR', power: float = 0):
         super().__init__(resource_name)
 
-        if not isinstance(self.instrument, SerialInstrument):
-            raise TypeError(
-                f"The instrument with name '{resource_name}' is not of type {SerialInstrument}.")
-
         self.wavelength_unit = "NM"
         self.frequency_unit = "GHZ"
         self._power_unit = "DBM"
         self.resolution = 0.001  # WARNING: This is in nm and doesn't consider wavelength_unit
         self.max_wait_time = 20
         self.name = "TUNICS"
+        self.settling = LearnedSettling()
+        self.last_step = None  # in nm, size of the last wavelength change. Used to predict the settle time
         self.offset = 9.835  # in nm. Actual laser wavelength is (set-offset)
-        self.instrument.read_termination = '\r'
-
-        # Empty the read register of anything from previous uses
-        i = 0
-        while True:
-            try:
-                self.instrument.read()
-            except VisaIOError as e:
-                break
-            i += 1
-            if i == 100:
-                raise TimeoutError(
-                    "Could not empty the readout register on the Tunics laser after 100 reads")
+        self._wavelength = None
+        self._pending = []  # writes whose "> " acknowledgement hasn't been read yet
+        self._configure_port()
 
         self.power_unit = self._power_unit
         self.set_state(True)
         self.set_power(power)  # Laser must be on to set power
         self.set_state(False)
         self.defined_power = power
+        self.sync()
 
     @property
     def power_unit(self):
@@ -259,19 +500,114 @@ class TunicsManager(InstrumentManager):
                 f"Power unit '{unit}' must be either 'DBM' or 'MW'")
 
         self._send_message(unit, read=False)
+        self.sync()
         self._power_unit = unit
 
-    def _send_message(self, message: str, read: bool = True):
+    def _configure_port(self):
+        """ Set the reply terminator and empty the read buffer of anything from previous uses. Only the bytes
+        already received are read, so this doesn't wait for a read to time out """
+        self.instrument.read_termination = '\r'
+        for _ in range(100):
+            waiting = self.instrument.bytes_in_buffer
+            if not waiting:
+                return
+            self.instrument.read_bytes(waiting)
+        raise TimeoutError(
+            "Could not empty the readout register on the Tunics laser after 100 reads")
+
+    def reconnect(self):
+        """ Close and reopen the serial port, e.g. after a timeout. Unlike creating a new TunicsManager the laser's
+        output and power are left as they are.
+
+        Writes still waiting for their acknowledgement may not have reached the laser, so their settings are dropped
+        from the state cache and an IOError naming them is raised once the port is open again """
+        lost, self._pending = self._pending, []
         try:
-            val = self.instrument.query(message).upper().strip("> ")
-            if "=" in val:
-                # Assume message is of the form "F?" and return is of the form "> f="
-                val = val.strip(f"{message[0]}=")
-            self._check_error(val)
-            if read:
-                return val
-        except VisaIOError as e:
-            raise IOError(e)
+            self.instrument.close()
+        except VisaIOError:
+            pass
+        self.instrument = self._open_resource(self.resource_name)
+        self._configure_port()
+
+        if lost:
+            for message in lost:
+                self._forget_command(message)
+            raise IOError(f"Reconnected to the Tunics laser without an acknowledgement of "
+                          f"{', '.join(repr(message) for message in lost)}")
+
+    def _forget_command(self, message: str):
+        """ Drop the cached settings which the write message changes """
+        quantities = self._command_settings.get(message.split("=")[0])
+        if quantities is None:
+            # Anything else, e.g. a change of unit, may have affected any setting
+            self._state.clear()
+        else:
+            self._forget(*quantities)
+        if message.startswith("L="):
+            self._wavelength = None
+
+    def _send_message(self, message: str, read: bool = True):
+        """ Every command is acknowledged with a "> " line, followed by the value of a query. Writes don't wait for
+        their acknowledgement: up to max_pending are sent back to back and their acknowledgements are checked before
+        the next query (or sync), so an error from a write is raised by a later call.
+
+        On a VISA error the port is reopened and the message sent once more before giving up. If writes were lost
+        with the port (see reconnect) a write is still sent again, so that e.g. the DISABLE of laser_control's error
+        handler switches the laser off, before the IOError naming the lost writes is raised """
+        for attempt in range(2):
+            try:
+                if not read:
+                    with self.stats.timed(message):
+                        self.instrument.write(message)
+                    self._pending.append(message)
+                    if len(self._pending) >= self.max_pending:
+                        self.sync()
+                    return
+                self.sync()
+                with self.stats.timed(message):
+                    return self._parse_reply(message, self.instrument.query(message))
+            except VisaIOError as e:
+                if attempt:
+                    raise IOError(e)
+                self.stats.record_retry(message)
+                try:
+                    self.reconnect()
+                except IOError as lost:
+                    if read:
+                        raise
+                    # The caller won't get to update the cache after the error
+                    self._forget_command(message)
+                    try:
+                        self._send_message(message, read=False)
+                        self.sync()
+                    except (IOError, VisaIOError) as e:
+                        raise IOError(f"{lost}, and sending '{message}' again failed: {e}") from e
+                    raise
+
+    def sync(self):
+        """ Read the acknowledgements of the writes sent so far, raising an IOError if any of them failed """
+        errors = []
+        while self._pending:
+            message = self._pending[0]
+            with self.stats.timed("ACK"):
+                reply = self.instrument.read()
+            # Only taken off once acknowledged, so a write whose acknowledgement times out is reported by reconnect
+            self._pending.pop(0)
+            try:
+                self._parse_reply(message, reply)
+            except IOError as e:
+                # Keep reading so the remaining acknowledgements aren't taken as the reply to the next query
+                errors.append(f"{e} in reply to '{message}'")
+        if errors:
+            raise IOError("; ".join(errors))
+
+    def _parse_reply(self, message: str, reply: str):
+        val = reply.upper().strip("> ")
+        if "=" in val:
+            # Assume message is of the form "F?" and return is of the form "> f="
+            val = val.strip(f"{message[0]}=")
+        self._check_error(val)
+        return val
 
     def _check_error(self, error: str):
         """ Tunics has two possible errors
@@ -290,89 +626,76 @@ class TunicsManager(InstrumentManager):
 
     def wait_steady_state(self):
         """
-        Checks if laser has reached steady state every 1 second by comparing the set and current
-        powers.
+        Waits for the laser to reach steady state using the settling strategy. Returns False if the laser has not
+        settled within max_wait_time. The observed settle time is kept in self.settling.last_settle_time
         """
-        elapsed_time = 0
-        delay_time = 1
-        while elapsed_time < self.max_wait_time:
-            if self.check_steady_state():
-                return True
-            time.sleep(delay_time)
-            elapsed_time += delay_time
-
-        return False
+        return self.settling.wait(self)
 
     def set_frequency(self, frequency: float):
-        if frequency < (min_freq := self.get_frequency("MIN")):
-            raise ValueError(f"Frequency '{frequency} {self.frequency_unit}' "
-                             f"is below laser minimum '{min_freq} {self.frequency_unit}'")
-        elif frequency > (max_freq := self.get_frequency("MAX")):
-            raise ValueError(f"Frequency '{frequency} {self.frequency_unit}' "
-                             f"is above laser maximum '{max_freq} {self.frequency_unit}'")
+        self._check_limits("frequency", frequency)
 
         self._send_message(f"F={frequency}", read=False)
+        self._remember("frequency", frequency)
+        self._forget("wavelength")
 
     def shift_frequency(self, frequency_shift: float):
         frequency = self.get_frequency()
         self.set_frequency(frequency + frequency_shift)
 
-    def get_frequency(self, param: str = ""):
+    def get_frequency(self, param: str = "", force: bool = False):
         """ param (str):
                         MIN: Return the minimum programmable value
                         MAX: Return the maximum programmable value
         Parameters hardcoded as Tunics-Plus does not return these values
+        The set value is served from the state cache unless force
         """
         if param == "MAX":
             return 199728.5
         elif param == "MIN":
             return 182800.3
         elif param == "":
-            return float(self._send_message(f"F? {param}"))
+            return self._recall("frequency", lambda: float(self._send_message(f"F? {param}")), force)
         self._check_error("COMMAND ERROR")
 
     def set_wavelength(self, wavelength: float):
-        if wavelength < (min_wav := self.get_wavelength("MIN")):
-            raise ValueError(f"Wavelength '{wavelength} {self.wavelength_unit}' "
-                             f"is below laser minimum '{min_wav} {self.wavelength_unit}'")
-        elif wavelength > (max_wav := self.get_wavelength("MAX")):
-            raise ValueError(f"Wavelength '{wavelength} {self.wavelength_unit}' "
-                             f"is above laser maximum '{max_wav} {self.wavelength_unit}'")
+        self._check_limits("wavelength", wavelength)
 
         self._send_message(f"L={wavelength}", read=False)
+        self.last_step = None if self._wavelength is None else abs(wavelength - self._wavelength)
+        self._wavelength = wavelength
+        self._remember("wavelength", wavelength)
+        self._forget("frequency")
 
     def shift_wavelength(self, wavelength_shift: float):
         wavelength = self.get_wavelength()
         self.set_wavelength(wavelength + wavelength_shift)
 
-    def get_wavelength(self, param: str = ""):
+    def get_wavelength(self, param: str = "", force: bool = False):
         """ param (str):
                         MIN: Return the minimum programmable value
                         MAX: Return the maximum programmable value
         Parameters hardcoded as Tunics-Plus does not return these values
+        The set value is served from the state cache unless force
         """
         if param == "MAX":
             return 1640
         elif param == "MIN":
             return 1510  # The laser can go lower but then the maximum power drops below what should be possible
         elif param == "":
-            return float(self._send_message(f"L?"))
+            return self._recall("wavelength", lambda: float(self._send_message(f"L?")), force)
         self._check_error("COMMAND ERROR")
 
     def set_power(self, power: float):
-        if power < (min_power := self.get_power("MIN")):
-            raise ValueError(f"Power '{power} {self.power_unit}' "
-                             f"is below laser minimum '{min_power} {self.power_unit}'")
-        elif power > (max_power := self.get_power("MAX")):
-            raise ValueError(f"Power '{power} {self.power_unit}' "
-                             f"is above laser maximum '{max_power} {self.power_unit}'")
+        self._check_limits("power", power)
 
         self._send_message(f"P={power}", read=False)
+        # Checked straight away so a rejected power is raised here and never becomes the defined power
+        self.sync()
         self.defined_power = power
 
     def shift_power(self, power_shift: float):
-        power = self.get_power()
-        self.set_power(power + power_shift)
+        # P? is the actual power, which may not have settled, so shift from the set power
+        self.set_power(self.defined_power + power_shift)
 
     def get_power(self, param: str = ""):
         """ param (str):
@@ -393,11 +716,12 @@ class TunicsManager(InstrumentManager):
         self._check_error("COMMAND ERROR")
 
     def set_state(self, state: bool):
-        self._send_message("ENABLE" if state else "DISABLE")
+        self._send_message("ENABLE" if state else "DISABLE", read=False)
+        self.sync()
+        self._remember("state", state)
 
-    def get_state(self):
-        val = self._send_message(f"P?")
-        return False if val == "DISABLED" else True
+    def get_state(self, force: bool = False):
+        return self._recall("state", lambda: self._send_message(f"P?") != "DISABLED", force)
 
     @property
     def _identify(self):
@@ -410,13 +734,11 @@ class PowerMeterManager(InstrumentManager):
         Thorlab power meter SCPI commands can be found in the docs folder
     """
 
+    resource_type = USBInstrument
+
     def __init__(self, resource_name: str = 'USB0::0x1313::0x8078::P0010441::INSTR', average: int = 100):
         super().__init__(resource_name)
 
-        if not isinstance(self.instrument, USBInstrument):
-            raise TypeError(
-                f"The instrument with name '{resource_name}' is not of type {USBInstrument}.")
-
         self.wavelength_unit = "NM"
         self.frequency_unit = "THZ"
         self._power_unit = "DBM"
@@ -441,32 +763,66 @@ class PowerMeterManager(InstrumentManager):
             raise ValueError(
                 f"Power unit '{unit}' must be either 'DBM' or 'W'")
 
-        self._send_message(f":SENSE:POWER:DC:UNIT {unit}", read=False)
-        self._send_message("Configure:Scalar:POWer", read=False)
+        with self.batch() as batch:
+            batch.write(f":SENSE:POWER:DC:UNIT {unit}")
+            batch.write("Configure:Scalar:POWer")
         self._power_unit = unit
 
     def set_wavelength(self, wavelength: float):
         self._send_message(
             f"{self.sense_prefix}:WAV {wavelength} {self.wavelength_unit}", read=False)
+        self._remember("wavelength", wavelength)
 
     def set_average(self, average: int):
         self._send_message(f":SENSE:AVERAGE:COUNT {average}", read=False)
+        self._remember("average", int(average))
 
-    def get_average(self):
-        return int(self._send_message(":SENSE:AVERAGE:COUNT?"))
+    def get_average(self, force: bool = False):
+        """ Served from the state cache unless force """
+        return self._recall("average", lambda: int(self._send_message(":SENSE:AVERAGE:COUNT?")), force)
 
     def shift_wavelength(self, wavelength_shift: float):
         wavelength = self.get_wavelength()
         self.set_wavelength(wavelength + wavelength_shift)
 
-    def get_wavelength(self):
-        # The power meter always returns wavelength in units of 'nm'
-        return float(self._send_message(f"{self.sense_prefix}:WAV?")) * \
-            unit_conversion[self.wavelength_unit] / unit_conversion["NM"]
+    def get_wavelength(self, force: bool = False):
+        """ Served from the state cache unless force """
+        def query():
+            # The power meter always returns wavelength in units of 'nm'
+            return float(self._send_message(f"{self.sense_prefix}:WAV?")) * \
+                unit_conversion[self.wavelength_unit] / unit_conversion["NM"]
+        return self._recall("wavelength", query, force)
 
     def read(self):
         return self._send_message(":READ?")
 
+    def read_burst(self, count: int):
+        """ Take count readings in one transaction and return them as an array.
+
+        The PM100D has no sample buffer to fetch from, so this is a compound message of count ':READ?' queries. Each
+        reading still averages over :SENSE:AVERAGE:COUNT samples but only one round-trip is paid for all of them.
+        """
+        with self.batch() as batch:
+            for _ in range(count):
+                batch.query(":READ?")
+        return np.array(batch.replies, dtype=float)
+
+    def set_wavelength_and_read(self, wavelength: float):
+        """ Set the correction wavelength and take a reading in a single transaction """
+        with self.batch() as batch:
+            batch.write(f"{self.sense_prefix}:WAV {wavelength} {self.wavelength_unit}")
+            batch.query(":READ?")
+        self._remember("wavelength", wavelength)
+        return batch.replies[0]
+
+
+def _same_setting(cached, actual):
+    """ Whether a cached setting matches the value read back, allowing for the rounding of the instrument's reply """
+    if isinstance(cached, (float, int, np.floating)) and isinstance(actual, (float, int, np.floating)) \
+            and not isinstance(cached, bool):
+        return bool(np.isclose(cached, actual, rtol=1e-6, atol=1e-6))
+    return cached == actual
+
 
 if __name__ == "__main__":
     laser = QuantifiManager()
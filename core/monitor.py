@@ -0,0 +1,114 @@
+""" This file is for the live progress monitor shown while a sweep is running """
+import time
+import numpy as np
+
+
+class SweepMonitor:
+    """
+    Live progress of a sweep: a single progress line with the latest reading and an ETA, and optionally a plot of
+    the mean power which is extended as the sweep runs.
+
+    Each point put() only updates the latest reading and the running minimum and maximum of the bin of consecutive
+    points it falls in, the same decimation as decimate_minmax, so neither the points nor the cost of a redraw grow
+    with the length of the sweep. Bins are sized to fit total_points into max_points points and are merged in pairs
+    if more points than that arrive. The display is redrawn at most every refresh_interval seconds.
+
+    Arguments:
+    total_points: number of points in the sweep, used for the ETA
+    refresh_interval: minimum seconds between redraws
+    plot: if True, show a live plot of mean power against wavelength
+    title: title of the plot
+    max_points: most points plotted
+    """
+
+    def __init__(self, total_points: int, refresh_interval: float = 0.5, plot: bool = False, title: str = "",
+                 max_points: int = 5000):
+        self.total_points = total_points
+        self.refresh_interval = refresh_interval
+        self.max_points = max_points
+        self.done = 0
+        self.wavelength = None  # of the latest point
+        self.power = None  # mean power of the latest point
+        self._start = time.monotonic()
+        self._last_refresh = self._start
+
+        # (index, wavelength, mean power) of the lowest and highest point of each bin, an even number of bins
+        n_bins = max(max_points // 4, 1) * 2
+        self._bin_size = max(-(-total_points // n_bins), 1)
+        self._low = np.full((n_bins, 3), np.nan)
+        self._high = np.full((n_bins, 3), np.nan)
+
+        self.figure = None
+        if plot:
+            # Only loaded when plotting so that sweeps without a live plot don't import matplotlib
+            import matplotlib.pyplot as plt
+            plt.ion()
+            self.figure, self.axes = plt.subplots()
+            self.line, = self.axes.plot([], [], ".", markersize=2)
+            self.axes.set_xlabel("Wavelength (nm)")
+            self.axes.set_ylabel("Power (dBm)")
+            if title:
+                self.axes.set_title(title)
+
+    def put(self, wavelength: float, readings):
+        power = float(np.mean(readings))
+        self.wavelength, self.power = wavelength, power
+        if self.done // self._bin_size >= len(self._low):
+            self._merge_bins()
+        i = self.done // self._bin_size
+        if not self._low[i, 2] <= power:
+            self._low[i] = self.done, wavelength, power
+        if not self._high[i, 2] >= power:
+            self._high[i] = self.done, wavelength, power
+        self.done += 1
+
+        if time.monotonic() - self._last_refresh >= self.refresh_interval:
+            self.refresh()
+
+    def _merge_bins(self):
+        """ Merge the bins in pairs, doubling the bin size, to make room for more points than total_points """
+        half = len(self._low) // 2
+        for extremes, pick in ((self._low, np.less), (self._high, np.greater)):
+            pairs = extremes.reshape(half, 2, 3)
+            second = pick(pairs[:, 1, 2], pairs[:, 0, 2])
+            extremes[:half] = np.where(second[:, None], pairs[:, 1], pairs[:, 0])
+            extremes[half:] = np.nan
+        self._bin_size *= 2
+
+    def plot_data(self):
+        """ Wavelengths and mean powers of the decimated points plotted so far """
+        if not self.done:
+            return np.array([]), np.array([])
+        used = (self.done - 1) // self._bin_size + 1
+        points = np.concatenate((self._low[:used], self._high[:used]))
+        _, first = np.unique(points[:, 0], return_index=True)
+        points = points[first]
+        return points[:, 1], points[:, 2]
+
+    def refresh(self):
+        self._last_refresh = time.monotonic()
+        if not self.done:
+            return
+
+        elapsed = self._last_refresh - self._start
+        eta = elapsed / self.done * max(self.total_points - self.done, 0)
+        print(f"\r{self.done}/{self.total_points} points ({100 * self.done / self.total_points:.1f}%) | "
+              f"{self.wavelength:.4f} nm {self.power:.3f} dBm | "
+              f"elapsed {elapsed:.0f}s ETA {eta:.0f}s", end="", flush=True)
+
+        if self.figure is not None:
+            self.line.set_data(*self.plot_data())
+            self.axes.relim()
+            self.axes.autoscale_view()
+            self.figure.canvas.draw_idle()
+            self.figure.canvas.flush_events()
+
+    def close(self):
+        self.refresh()
+        print()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,114 @@
+""" This file is for strategies used to wait for a laser to reach steady state after it has been set """
+import time
+import numpy as np
+
+
+class SettlingStrategy:
+    """ Base class for waiting until a laser has settled
+
+    Polls the laser with an exponential backoff starting at initial_delay seconds, so a laser that settles in a few
+    milliseconds is not held up by a fixed polling period. The observed settle time of the last wait is kept in
+    last_settle_time (NaN if the laser did not settle within laser.max_wait_time). A sweep records the settle time of
+    each of its points in ExperimentalSetUp.settle_times.
+    """
+
+    def __init__(self, initial_delay: float = 0.002, factor: float = 2, max_delay: float = 0.5):
+        self.initial_delay = initial_delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.last_settle_time = None
+        self.last_initial_wait = 0  # seconds slept before the first poll of the last wait
+        self.last_polls = 0  # number of polls made by the last wait
+
+    def is_settled(self, laser) -> bool:
+        return laser.check_steady_state()
+
+    def initial_wait(self, laser) -> float:
+        """ Time in seconds to sleep before the first poll """
+        return 0
+
+    def wait(self, laser) -> bool:
+        start = time.perf_counter()
+        settled = self._poll(laser, start)
+        self.last_settle_time = time.perf_counter() - start if settled else np.nan
+        self.record(laser, self.last_settle_time)
+        return settled
+
+    def record(self, laser, settle_time: float):
+        """ Hook for strategies which learn from the observed settle times """
+        return
+
+    def _poll(self, laser, start: float) -> bool:
+        delay = self.initial_delay
+        self.last_initial_wait = self.initial_wait(laser)
+        self.last_polls = 0
+        if self.last_initial_wait > 0:
+            time.sleep(self.last_initial_wait)
+
+        while True:
+            self.last_polls += 1
+            if self.is_settled(laser):
+                return True
+            elapsed = time.perf_counter() - start
+            if elapsed >= laser.max_wait_time:
+                return False
+            time.sleep(min(delay, laser.max_wait_time - elapsed))
+            delay = min(delay * self.factor, self.max_delay)
+
+
+class LockSettling(SettlingStrategy):
+    """ Settling for lasers which can report whether they are locked to the set wavelength (e.g. the Quantifi).
+    Each poll is a single LOCK query instead of comparing the set and actual powers.
+    """
+
+    def is_settled(self, laser) -> bool:
+        return laser.is_locked()
+
+
+class LearnedSettling(SettlingStrategy):
+    """ Settling for lasers with no lock query (e.g. the Tunics)
+
+    Learns a low quantile of the settle time for each size of the last wavelength step (laser.last_step, in nm,
+    binned by step_bins) and sleeps for it before polling, so that the laser isn't queried while it is almost certain
+    to still be moving.
+
+    Whether the laser had settled by the end of the sleep is known from the first poll, so the estimate is moved
+    towards the quantile from that alone: down by rate * (1 - quantile) of itself when the first poll finds the laser
+    settled and up by rate * quantile when it doesn't. The first settle time of a bin, measured without a sleep, is
+    the starting estimate. Only one number is kept per bin, and the estimate can come down as well as up, e.g. after
+    a slow first point.
+    """
+
+    def __init__(self, step_bins=np.logspace(-3, 2, 11), quantile: float = 0.1, rate: float = 0.2, **kwargs):
+        super().__init__(**kwargs)
+        self.step_bins = np.asarray(step_bins)
+        self.quantile = quantile
+        self.rate = rate
+        self.estimates = np.full(len(self.step_bins) + 1, np.nan)
+
+    def _bin(self, laser):
+        step = getattr(laser, "last_step", None)
+        if step is None:
+            return None
+        return int(np.digitize(step, self.step_bins))
+
+    def predict(self, step: float):
+        """ Predicted settle time in seconds for a wavelength step of step nm, or 0 if nothing is known yet """
+        estimate = self.estimates[int(np.digitize(step, self.step_bins))]
+        return 0 if np.isnan(estimate) else estimate
+
+    def initial_wait(self, laser) -> float:
+        step = getattr(laser, "last_step", None)
+        return 0 if step is None else self.predict(step)
+
+    def record(self, laser, settle_time: float):
+        if (i := self._bin(laser)) is None:
+            return
+        if np.isnan(self.estimates[i]):
+            if not np.isnan(settle_time):
+                self.estimates[i] = settle_time
+        elif self.last_polls == 1 and not np.isnan(settle_time):
+            # Settled within the sleep, which could have been shorter
+            self.estimates[i] *= 1 - self.rate * (1 - self.quantile)
+        else:
+            self.estimates[i] *= 1 + self.rate * self.quantile
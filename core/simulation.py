@@ -0,0 +1,511 @@
+""" This file is for simulated instruments, used to develop and benchmark sweeps without the hardware
+
+The simulated resources stand in for the pyvisa resources underneath the real managers, so everything above the
+VISA layer (batching, error checking, settling, the sweeps in core.control) runs unchanged. A SimulatedBench holds
+the state shared by the laser and the power meter, and the power meter reads the transmission of a RingResonator at
+the wavelength the laser is actually at.
+
+setup = simulated_setup("QUANTIFI", latency=0.002, noise=0.02)
+setup.perform_wavelength_sweep(1545, 1555, 0.01, save=False, graph=False)
+"""
+import re
+import threading
+import time
+
+import numpy as np
+from pyvisa.constants import StatusCode
+from pyvisa.errors import VisaIOError
+
+from core.instruments import QuantifiManager, TunicsManager, PowerMeterManager
+from core.utils import c
+
+
+class RingResonator:
+    """
+    Transmission of an all-pass ring resonator, the device usually being measured.
+
+    Arguments:
+    group_index: group index of the ring waveguide
+    length: circumference of the ring in um
+    self_coupling: fraction of the field amplitude which passes the coupler without entering the ring
+    loss: fraction of the field amplitude which survives one round trip of the ring
+    phase: extra round trip phase in radians, moves the resonances within an FSR
+    """
+
+    def __init__(self, group_index: float = 3.4, length: float = 180, self_coupling: float = 0.97,
+                 loss: float = 0.98, phase: float = 0):
+        self.group_index = group_index
+        self.length = length
+        self.self_coupling = self_coupling
+        self.loss = loss
+        self.phase = phase
+
+    def transmission(self, wavelengths):
+        """ Linear power transmission at wavelengths in nm. Broadcasts over any shape of array """
+        phi = 2 * np.pi * self.group_index * self.length * 1e3 / np.asarray(wavelengths, dtype=float) + self.phase
+        r, a = self.self_coupling, self.loss
+        return (a ** 2 - 2 * r * a * np.cos(phi) + r ** 2) / (1 - 2 * r * a * np.cos(phi) + (r * a) ** 2)
+
+    def transmission_db(self, wavelengths):
+        return 10 * np.log10(self.transmission(wavelengths))
+
+    def fsr(self, wavelength: float = 1550):
+        """ Free spectral range in nm around wavelength in nm """
+        return wavelength ** 2 / (self.group_index * self.length * 1e3)
+
+    def fwhm(self, wavelength: float = 1550):
+        """ Full width at half maximum of the resonances in nm around wavelength in nm """
+        ra = self.self_coupling * self.loss
+        return (1 - ra) * self.fsr(wavelength) / (np.pi * np.sqrt(ra))
+
+    def resonances(self, wavelength_start: float, wavelength_end: float):
+        """ Wavelengths in nm of the resonances between wavelength_start and wavelength_end """
+        # Resonances are where the round trip phase is a multiple of 2 pi
+        optical_length = self.group_index * self.length * 1e3
+        orders = np.arange(np.ceil((optical_length * 2 * np.pi / wavelength_end + self.phase) / (2 * np.pi)),
+                           np.floor((optical_length * 2 * np.pi / wavelength_start + self.phase) / (2 * np.pi)) + 1)
+        return np.sort(2 * np.pi * optical_length / (2 * np.pi * orders - self.phase))
+
+
+class SimulatedBench:
+    """
+    State shared by a simulated laser and power meter: the laser's wavelength, power and output state and the device
+    between them.
+
+    After a wavelength change the laser takes settle_time + settle_time_per_nm * step seconds to settle. Until then
+    its wavelength moves linearly towards the new one and its actual power is unsettled_power_error dB away from
+    the set power, so that LOCK and SET/ACT power polling behave as on the real lasers.
+
+    Arguments:
+    device: the device under test, a RingResonator by default. Anything with a transmission(wavelengths) method
+    insertion_loss: loss in dB of the fibre coupling and everything else in the path
+    noise: standard deviation in dB of a single power meter sample
+    noise_floor: reading in dBm with the laser off
+    detector_noise: standard deviation in mW of noise added to the optical power of a single sample, which makes
+    readings noisier in dB the less light there is, e.g. at the bottom of a resonance. 0 for none
+    seed: seed of the noise, for reproducible runs
+    """
+
+    def __init__(self, device=None, insertion_loss: float = 10, noise: float = 0.05, noise_floor: float = -80,
+                 settle_time: float = 0.005, settle_time_per_nm: float = 0.02, unsettled_power_error: float = 1,
+                 detector_noise: float = 0, seed: int = None):
+        self.device = RingResonator() if device is None else device
+        self.insertion_loss = insertion_loss
+        self.noise = noise
+        self.noise_floor = noise_floor
+        self.settle_time = settle_time
+        self.settle_time_per_nm = settle_time_per_nm
+        self.unsettled_power_error = unsettled_power_error
+        self.detector_noise = detector_noise
+        self.rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+
+        self.state = False
+        self.power = 0  # dBm
+        self._wavelength = 1550  # nm
+        self._previous_wavelength = 1550
+        self._move_start = 0
+        self._move_duration = 0
+
+    def set_wavelength(self, wavelength: float):
+        with self._lock:
+            now = time.perf_counter()
+            self._previous_wavelength = self._actual_wavelength(now)
+            self._wavelength = wavelength
+            self._move_start = now
+            self._move_duration = self.settle_time + self.settle_time_per_nm * abs(wavelength -
+                                                                                   self._previous_wavelength)
+
+    def get_wavelength(self):
+        return self._wavelength
+
+    def actual_wavelength(self):
+        with self._lock:
+            return self._actual_wavelength(time.perf_counter())
+
+    def _actual_wavelength(self, now: float):
+        progress = 1 if self._move_duration == 0 else min((now - self._move_start) / self._move_duration, 1)
+        return self._previous_wavelength + progress * (self._wavelength - self._previous_wavelength)
+
+    def is_settled(self):
+        return time.perf_counter() - self._move_start >= self._move_duration
+
+    def actual_power(self):
+        return self.power if self.is_settled() else self.power - self.unsettled_power_error
+
+    def measure(self, averages: int = 1):
+        """ A power meter reading in dBm averaged over averages samples """
+        if not self.state:
+            return self.noise_floor + self.rng.normal(0, self.noise / np.sqrt(averages))
+        transmission = 10 * np.log10(self.device.transmission(self.actual_wavelength()))
+        power = self.actual_power() + transmission - self.insertion_loss
+        if self.detector_noise > 0:
+            milliwatts = 10 ** (power / 10) + self.rng.normal(0, self.detector_noise / np.sqrt(averages))
+            power = 10 * np.log10(max(milliwatts, 10 ** (self.noise_floor / 10)))
+        return max(power, self.noise_floor) + self.rng.normal(0, self.noise / np.sqrt(averages))
+
+
+class SimulatedResource:
+    """
+    Base class of the simulated pyvisa resources.
+
+    Sending a message costs command_latency seconds for each ';' separated command in it. The instrument handles
+    messages one at a time and the reply to each is ready to read latency seconds after the instrument gets to it,
+    so writes which don't wait for a reply can be pipelined. A read with no reply coming waits for the timeout (in
+    ms, as pyvisa) before raising a VisaIOError. The number of messages and commands sent are counted in
+    round_trips and commands_sent.
+
+    Errors are injected at random: with probability command_error_rate a command is rejected as an instrument would
+    reject an invalid command, and with probability timeout_rate a read times out.
+    """
+
+    def __init__(self, bench: SimulatedBench, latency: float = 0.001, command_latency: float = 0.0001,
+                 command_error_rate: float = 0, timeout_rate: float = 0, seed: int = None):
+        self.bench = bench
+        self.latency = latency
+        self.command_latency = command_latency
+        self.command_error_rate = command_error_rate
+        self.timeout_rate = timeout_rate
+        self.rng = np.random.default_rng(seed)
+        self.timeout = 2000
+        self.read_termination = None
+        self.write_termination = "\n"
+        self.round_trips = 0
+        self.commands_sent = 0
+        self._replies = []  # (time the reply is ready, reply)
+        self._busy_until = 0
+
+    def _transaction(self, message: str):
+        """ Pay the cost of sending message and return its commands """
+        commands = [command.strip() for command in message.split(";") if command.strip()]
+        self.round_trips += 1
+        self.commands_sent += len(commands)
+        if self.command_latency > 0:
+            time.sleep(self.command_latency * len(commands))
+        return commands
+
+    def _timeout(self):
+        time.sleep(self.timeout / 1000)
+        return VisaIOError(StatusCode.error_timeout)
+
+    def _inject_command_error(self):
+        return self.command_error_rate > 0 and self.rng.random() < self.command_error_rate
+
+    def write(self, message: str):
+        replies = self._handle(self._transaction(message))
+        self._busy_until = max(self._busy_until, time.perf_counter()) + self.latency
+        self._replies += [(self._busy_until, reply) for reply in replies]
+
+    def query(self, message: str):
+        self.write(message)
+        return self.read()
+
+    def _wait_for_reply(self):
+        if not self._replies or (self.timeout_rate > 0 and self.rng.random() < self.timeout_rate):
+            self._replies = []
+            raise self._timeout()
+        (ready, reply), self._replies = self._replies[0], self._replies[1:]
+        if (wait := ready - time.perf_counter()) > 0:
+            time.sleep(wait)
+        return reply
+
+    def read(self):
+        reply = self._wait_for_reply()
+        # As with pyvisa, the line ending is only stripped if read_termination is set
+        return reply + "\n" if self.read_termination is None else reply
+
+    @property
+    def bytes_in_buffer(self):
+        """ Number of bytes of the replies which have already arrived """
+        now = time.perf_counter()
+        return sum(len(reply) + 1 for ready, reply in self._replies if ready <= now)
+
+    def read_bytes(self, count: int):
+        """ Read count bytes. Only whole replies are simulated so every reply started within count is read """
+        data = b""
+        while len(data) < count:
+            data += (self._wait_for_reply() + (self.read_termination or "\n")).encode()
+        return data
+
+    def _handle(self, commands: list) -> list:
+        raise NotImplementedError
+
+    def close(self):
+        self._replies = []
+
+    def __repr__(self):
+        return f"<{type(self).__name__}>"
+
+
+class SimulatedSCPIResource(SimulatedResource):
+    """ Simulated instrument which takes ';' separated SCPI commands and replies to all the queries in a message with
+    one ';' separated line. A rejected command sets the command error bit of *ESR? and the message gets no reply, as
+    on the real instruments """
+
+    identity = "Simulated SCPI instrument"
+
+    def __init__(self, bench: SimulatedBench, **kwargs):
+        super().__init__(bench, **kwargs)
+        self.event_status = 0
+
+    def _handle(self, commands: list) -> list:
+        replies = []
+        for command in commands:
+            header, _, argument = command.partition(" ")
+            header, argument = header.upper(), argument.strip().upper()
+            if header == "*ESR?":
+                replies.append(str(self.event_status))
+                self.event_status = 0
+                continue
+            if header == "*OPC?":
+                replies.append("1")
+                continue
+            if header == "*IDN?":
+                replies.append(self.identity)
+                continue
+
+            reply = None if self._inject_command_error() else self._command(header, argument)
+            if reply is None:
+                self.event_status |= 32
+                return []
+            if reply is not True:
+                replies.append(reply)
+        return [";".join(replies)] if replies else []
+
+    def _command(self, header: str, argument: str):
+        """ Carry out a command. Returns the reply of a query, True for a write or None if the command is invalid """
+        raise NotImplementedError
+
+
+def _match(header: str, pattern: str):
+    """ Match a SCPI header against pattern, in which lowercase letters are optional, e.g. ':SENSe:AVERage:COUNt' """
+    query = pattern.endswith("?")
+    parts = []
+    for node in pattern.rstrip("?").strip(":").split(":"):
+        short = node.rstrip("abcdefghijklmnopqrstuvwxyz")
+        parts.append(re.escape(short) + (f"(?:{node[len(short):].upper()})?" if short != node else ""))
+    return re.fullmatch(":?" + ":".join(parts) + ("\\?" if query else ""), header) is not None
+
+
+class SimulatedQuantifi(SimulatedSCPIResource):
+    """ Simulated Quantifi Laser 1000. Wavelengths are replied in m and frequencies in Hz """
+
+    identity = "QUANTIFI PHOTONICS,LASER 1000 (SIMULATED),0,1.0"
+
+    def __init__(self, bench: SimulatedBench, wavelength_range=(1527.6, 1568.8), power_range=(6, 13.5), **kwargs):
+        super().__init__(bench, **kwargs)
+        self.wavelength_range = wavelength_range
+        self.power_range = power_range
+
+    def _command(self, header: str, argument: str):
+        bench = self.bench
+        prefix = ":SOURCE1:CHAN1"
+        if header == f"{prefix}:WAV":
+            wavelength = _value(argument, {"NM": 1, "UM": 1e3, "MM": 1e6})
+            if wavelength is None or not self.wavelength_range[0] <= wavelength <= self.wavelength_range[1]:
+                return None
+            bench.set_wavelength(wavelength)
+            return True
+        if header == f"{prefix}:FREQ":
+            frequency = _value(argument, {"THZ": 1e12, "GHZ": 1e9, "MHZ": 1e6, "KHZ": 1e3})
+            if frequency is None:
+                return None
+            return self._command(f"{prefix}:WAV", f"{c / (frequency * 1e12) * 1e9} NM")
+        if header == f"{prefix}:POW":
+            power = _value(argument, {"DBM": 1})
+            if power is None or not self.power_range[0] <= power <= self.power_range[1]:
+                return None
+            bench.power = power
+            return True
+        if header == f"{prefix}:WAV?":
+            return self._wavelength_query(argument)
+        if header == f"{prefix}:FREQ?":
+            # The highest frequency is at the lowest wavelength
+            wavelength = self._wavelength_query({"MIN": "MAX", "MAX": "MIN"}.get(argument, argument))
+            if wavelength is None or argument == "LOCK":
+                return wavelength
+            return f"{c / float(wavelength):.6f}"
+        if header == f"{prefix}:POW?":
+            values = {"": bench.actual_power(), "ACT": bench.actual_power(), "SET": bench.power,
+                      "MIN": self.power_range[0], "MAX": self.power_range[1], "DEF": 10}
+            return f"{values[argument]:.3f}" if argument in values else None
+        if header == ":OUTP1:CHAN1:STATE":
+            if argument not in ("ON", "OFF"):
+                return None
+            bench.state = argument == "ON"
+            return True
+        if header == ":OUTP1:CHAN1:STATE?":
+            return "ON" if bench.state else "OFF"
+        return None
+
+    def _wavelength_query(self, argument: str):
+        if argument == "LOCK":
+            return "1" if self.bench.is_settled() else "0"
+        values = {"": self.bench.get_wavelength(), "SET": self.bench.get_wavelength(),
+                  "ACT": self.bench.actual_wavelength(), "MIN": self.wavelength_range[0],
+                  "MAX": self.wavelength_range[1], "DEF": 1550}
+        return f"{values[argument] * 1e-9:.12e}" if argument in values else None
+
+
+class SimulatedPowerMeter(SimulatedSCPIResource):
+    """ Simulated Thorlabs PM100D. Each reading takes sample_time seconds for every sample averaged """
+
+    identity = "Thorlabs,PM100D (SIMULATED),P0000000,1.0"
+
+    def __init__(self, bench: SimulatedBench, sample_time: float = 0.0003, **kwargs):
+        super().__init__(bench, **kwargs)
+        self.sample_time = sample_time
+        self.average = 1
+        self.wavelength = 1550
+        self.unit = "DBM"
+
+    def _command(self, header: str, argument: str):
+        if _match(header, ":READ?") or _match(header, ":MEASure?"):
+            if self.sample_time > 0:
+                time.sleep(self.sample_time * self.average)
+            power = self.bench.measure(self.average)
+            return f"{power if self.unit == 'DBM' else 10 ** (power / 10) / 1000:.6E}"
+        if _match(header, ":SENSe:AVERage:COUNt"):
+            try:
+                self.average = max(int(float(argument)), 1)
+            except ValueError:
+                return None
+            return True
+        if _match(header, ":SENSe:AVERage:COUNt?"):
+            return str(self.average)
+        if _match(header, ":SENSe:CORRection:WAVelength"):
+            wavelength = _value(argument, {"NM": 1, "UM": 1e3})
+            if wavelength is None:
+                return None
+            self.wavelength = wavelength
+            return True
+        if _match(header, ":SENSe:CORRection:WAVelength?"):
+            return f"{self.wavelength:.6f}"
+        if _match(header, ":SENSe:POWer:DC:UNIT"):
+            if argument not in ("DBM", "W"):
+                return None
+            self.unit = argument
+            return True
+        if _match(header, ":CONFigure:SCALar:POWer"):
+            return True
+        return None
+
+
+class SimulatedTunics(SimulatedResource):
+    """ Simulated Tunics Plus. Every command gets its own reply line starting with "> " and errors are replied as
+    COMMANDERROR or VALUEERROR """
+
+    def __init__(self, bench: SimulatedBench, wavelength_range=(1500, 1640), power_range=(-6.88, 7.1), **kwargs):
+        super().__init__(bench, **kwargs)
+        self.wavelength_range = wavelength_range
+        self.power_range = power_range
+        self.unit = "DBM"
+
+    def _handle(self, commands: list) -> list:
+        return ["> " + ("COMMANDERROR" if self._inject_command_error() else self._command(command.upper()))
+                for command in commands]
+
+    def _command(self, command: str):
+        bench = self.bench
+        if command in ("DBM", "MW"):
+            self.unit = command
+            return ""
+        if command in ("ENABLE", "DISABLE"):
+            bench.state = command == "ENABLE"
+            return ""
+        if command == "L?":
+            return f"L={bench.get_wavelength():.3f}"
+        if command == "F?":
+            return f"F={c / bench.get_wavelength():.1f}"
+        if command == "P?":
+            if not bench.state:
+                return "DISABLED"
+            power = bench.actual_power()
+            return f"P={power if self.unit == 'DBM' else 10 ** (power / 10):.2f}"
+
+        quantity, equals, value = command.partition("=")
+        if not equals or quantity not in ("L", "F", "P"):
+            return "COMMANDERROR"
+        try:
+            value = float(value)
+        except ValueError:
+            return "VALUEERROR"
+        if quantity == "F":
+            quantity, value = "L", c / value
+        if quantity == "L":
+            if not self.wavelength_range[0] <= value <= self.wavelength_range[1]:
+                return "VALUEERROR"
+            bench.set_wavelength(value)
+        else:
+            power = value if self.unit == "DBM" else 10 * np.log10(value)
+            if not bench.state or not self.power_range[0] <= power <= self.power_range[1]:
+                return "VALUEERROR"
+            bench.power = power
+        return ""
+
+
+def _value(argument: str, units: dict):
+    """ Parse a SCPI argument such as '1550.0 NM' into a float in the first unit of units """
+    number, _, unit = argument.partition(" ")
+    try:
+        value = float(number)
+    except ValueError:
+        return None
+    unit = unit.strip() or next(iter(units))
+    return value * units[unit] / next(iter(units.values())) if unit in units else None
+
+
+class SimulatedManager:
+    """ Mixin which makes a manager talk to a simulated resource instead of opening a VISA resource """
+
+    def _open_resource(self, resource_name: str):
+        return self._resource
+
+
+class SimulatedQuantifiManager(SimulatedManager, QuantifiManager):
+    def __init__(self, resource: SimulatedQuantifi = None, power: float = 7.5):
+        self._resource = SimulatedQuantifi(SimulatedBench()) if resource is None else resource
+        super().__init__("SIMULATED::QUANTIFI", power)
+
+
+class SimulatedTunicsManager(SimulatedManager, TunicsManager):
+    def __init__(self, resource: SimulatedTunics = None, power: float = 0):
+        self._resource = SimulatedTunics(SimulatedBench()) if resource is None else resource
+        super().__init__("SIMULATED::TUNICS", power)
+
+
+class SimulatedPowerMeterManager(SimulatedManager, PowerMeterManager):
+    def __init__(self, resource: SimulatedPowerMeter = None, average: int = 100):
+        self._resource = SimulatedPowerMeter(SimulatedBench()) if resource is None else resource
+        super().__init__("SIMULATED::POWER_METER", average)
+
+
+def simulated_setup(laser: str = "QUANTIFI", bench: SimulatedBench = None, average: int = 100,
+                    laser_kwargs: dict = None, power_meter_kwargs: dict = None, **kwargs):
+    """
+    An ExperimentalSetUp of a simulated laser and power meter sharing a bench.
+
+    Arguments:
+    laser: QUANTIFI or TUNICS
+    bench: SimulatedBench of the device and noise, a default ring resonator if None
+    average: power meter averages
+    laser_kwargs, power_meter_kwargs: passed to the resource of just the laser or the power meter,
+    e.g. {"sample_time": 0}
+    kwargs: passed to both resources, e.g. latency, command_latency, command_error_rate, timeout_rate
+
+    Returns:
+    ExperimentalSetUp
+    """
+    from core.control import ExperimentalSetUp
+
+    bench = SimulatedBench() if bench is None else bench
+    laser_kwargs = {**kwargs, **(laser_kwargs or {})}
+    power_meter_kwargs = {**kwargs, **(power_meter_kwargs or {})}
+    if laser.upper() == "QUANTIFI":
+        laser = SimulatedQuantifiManager(SimulatedQuantifi(bench, **laser_kwargs))
+    elif laser.upper() == "TUNICS":
+        laser = SimulatedTunicsManager(SimulatedTunics(bench, **laser_kwargs))
+    else:
+        raise ValueError(f"Laser '{laser}' must be either 'QUANTIFI' or 'TUNICS'")
+    power_meter = SimulatedPowerMeterManager(SimulatedPowerMeter(bench, **power_meter_kwargs), average)
+    return ExperimentalSetUp(laser, power_meter)
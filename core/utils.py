@@ -1,8 +1,15 @@
 """ File to hold utility functions """
 import datetime
+import json
 import os
-from core.analysis import data_directory, plot_sweep
+import re
+import time
+from pathlib import Path
 import contextlib
+import numpy as np
+
+root = Path(__file__).parents[1]
+data_directory = root/"Data"
 
 unit_conversion = {"NM": 1e-9, "UM": 1e-6, "MM": 1e-3,
                    "THZ": 1e12, "GHZ": 1e9, "MHZ": 1e6, "KHZ": 1e3}
@@ -17,32 +24,250 @@ def wavelength_to_frequency(wavelength: float, wavelength_unit: str, frequency_u
     return c / (wavelength * unit_conversion[frequency_unit] * unit_conversion[wavelength_unit])
 
 @contextlib.contextmanager
-def open_time_stamped_file(filename: str=None, start_time: str=None, graph: bool=True, save: bool=True):
+def open_time_stamped_file(filename: str=None, start_time: str=None, graph: bool=True, save: bool=True,
+                           extension: str = ".txt", metadata: dict = None, path=None):
     """ Create a directory for today's date and a file for the time
 
     Probably a better wya to handle saving as an option but I couldn't think of it in the moment
+    Files with any extension other than .txt are opened in binary mode
+    Saved files are added to the catalogue (see core.catalogue) along with metadata
+    If path is given that file is appended to instead, e.g. to resume a sweep (see core.checkpoint)
     """
     today_directory = datetime.datetime.now().strftime('%d-%m-%Y')
     if start_time is None:
         start_time = datetime.datetime.now().strftime("%d-%m-%Y_%H-%M")
     save_dir = data_directory / today_directory
-    savefile_name = fr"{start_time}{'_' + filename if filename else ''}.txt"
-    save_path = save_dir / savefile_name
+    savefile_name = fr"{start_time}{'_' + filename if filename else ''}{extension}"
+    save_path = save_dir / savefile_name if path is None else Path(path)
 
     if save:
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir)
+        os.makedirs(save_path.parent, exist_ok=True)
 
-        file = open(save_path, "w")
+        if path is None:
+            file = open(save_path, "w" if extension == ".txt" else "wb")
+        else:
+            file = open(save_path, "a" if save_path.suffix == ".txt" else "r+b")
+            file.seek(0, os.SEEK_END)
         yield file
         file.close()
         print(fr"Saving data to {save_path}")
+
+        from core.catalogue import Catalogue
+        Catalogue(data_directory).add(save_path, metadata)
     else:
         yield None
 
-    if graph:
-        plot_sweep(f"{today_directory}/{savefile_name}", filename if filename else "", save=True)
+    # Plotting is done in a background process so it doesn't hold up the next measurement
+    if graph and save:
+        from core.analysis import plot_sweep_async
+        plot_sweep_async(str(save_path), filename if filename else "", save=True)
+
+
+class SweepWriter:
+    """ Buffers sweep rows of (wavelength, reading_0, ..., reading_n) into a NumPy block and writes the whole block
+    to file at once when block_size rows are buffered or flush_interval seconds have passed since the last write.
+
+    Every write is flushed and fsynced so after a crash the file holds every row up to the last write. If file is
+    None (i.e. not saving) rows are discarded. Use recover_sweep_file before appending to a file from a crashed run,
+    and pass the number of rows it returns as rows_written.
+    """
+
+    def __init__(self, file, reps: int, block_size: int = 256, flush_interval: float = 10, header: bool = True,
+                 fmt: str = "%.12g", rows_written: int = 0):
+        self.file = file
+        self.reps = reps
+        self.block = np.empty((block_size, reps + 1))
+        self.flush_interval = flush_interval
+        self.fmt = fmt
+        self.n_buffered = 0
+        self.rows_written = rows_written
+        self._last_flush = time.monotonic()
+
+        # A file being appended to which holds no rows yet may already have its header
+        if header and file is not None and not rows_written and not self.file.tell():
+            self.file.write("wavelength_nm " + "".join(f",power_reading_{j}_dbm " for j in range(reps)) + "\n")
+
+    def append(self, wavelength: float, readings):
+        if self.file is None:
+            return
+        self.block[self.n_buffered, 0] = wavelength
+        self.block[self.n_buffered, 1:] = readings
+        self.n_buffered += 1
+        if self.n_buffered == len(self.block) or time.monotonic() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def extend(self, wavelengths, power_readings):
+        """ Append many rows, with power_readings of dim((reps, len(wavelengths))) as returned by the sweeps """
+        for i, wavelength in enumerate(wavelengths):
+            self.append(wavelength, power_readings[:, i])
+
+    def flush(self):
+        if self.file is None:
+            return
+        if self.n_buffered:
+            self._write_block(self.block[:self.n_buffered])
+            self.rows_written += self.n_buffered
+            self.n_buffered = 0
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._last_flush = time.monotonic()
 
+    def _write_block(self, block):
+        np.savetxt(self.file, block, fmt=self.fmt, delimiter=", ")
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Rows are flushed even if the sweep failed so that they aren't lost
+        self.close()
+
+
+NPY_HEADER_LENGTH = 128
+
+
+def _npy_header(shape: tuple):
+    """ A version 1.0 .npy header for a float64 array, padded to a fixed length so it can be rewritten in place """
+    magic = b"\x93NUMPY\x01\x00"
+    length = NPY_HEADER_LENGTH - len(magic) - 2
+    header = repr({"descr": "<f8", "fortran_order": False, "shape": shape})
+    return magic + length.to_bytes(2, "little") + header.ljust(length - 1).encode("latin1") + b"\n"
+
+
+class BinarySweepWriter(SweepWriter):
+    """ SweepWriter which saves the rows as float64 in a .npy file so they can be memory-mapped with
+    np.load(path, mmap_mode="r"). The shape in the header is rewritten on every flush so the file is always loadable.
+
+    metadata (laser, averages, sensitivity, start, stop, res, ...) is saved alongside in a .json file of the same name,
+    and saved again on close so that anything added to it during the sweep is kept
+    """
+
+    def __init__(self, file, reps: int, metadata: dict = None, block_size: int = 256, flush_interval: float = 10,
+                 rows_written: int = 0):
+        super().__init__(file, reps, block_size, flush_interval, header=False, rows_written=rows_written)
+        self.metadata = metadata
+        if file is not None and not rows_written:
+            if not self.file.tell():
+                self.file.write(_npy_header((0, reps + 1)))
+            self.save_metadata()
+
+    def save_metadata(self):
+        with open(Path(self.file.name).with_suffix(".json"), "w") as metadata_file:
+            json.dump(self.metadata or {}, metadata_file, indent=4)
+
+    def _write_block(self, block):
+        self.file.write(block.astype("<f8").tobytes())
+        position = self.file.tell()
+        self.file.seek(0)
+        self.file.write(_npy_header((self.rows_written + len(block), self.reps + 1)))
+        self.file.seek(position)
+
+    def close(self):
+        super().close()
+        if self.file is not None and self.metadata is not None:
+            self.save_metadata()
+
+
+def sweep_writer(file, reps: int, metadata: dict = None, rows_written: int = 0):
+    """ Return the SweepWriter for a file opened by open_time_stamped_file, depending on whether it is binary.
+    rows_written is the number of rows already in a file being appended to """
+    if file is not None and "b" in file.mode:
+        return BinarySweepWriter(file, reps, metadata, rows_written=rows_written)
+    return SweepWriter(file, reps, rows_written=rows_written)
+
+
+def recover_sweep_file(path):
+    """ Make a sweep file from a crashed run safe to append to by removing any partially written last row and, for
+    .npy files, updating the header to the number of rows actually written. A .npy file which stopped before the end
+    of its header is emptied, for the SweepWriter appending to it to write the header. Returns the number of complete
+    rows """
+    path = Path(path)
+    with open(path, "rb+") as file:
+        if path.suffix == ".npy":
+            if os.path.getsize(path) < NPY_HEADER_LENGTH:
+                file.truncate(0)
+                return 0
+            np.lib.format.read_magic(file)
+            shape, _, _ = np.lib.format.read_array_header_1_0(file)
+            n_columns = shape[1]
+            row_bytes = 8 * n_columns
+            rows = (os.path.getsize(path) - NPY_HEADER_LENGTH) // row_bytes
+            file.truncate(NPY_HEADER_LENGTH + rows * row_bytes)
+            file.seek(0)
+            file.write(_npy_header((rows, n_columns)))
+            return rows
+
+        data = file.read()
+        if data and not data.endswith(b"\n"):
+            file.truncate(data.rfind(b"\n") + 1)
+            data = data[:data.rfind(b"\n") + 1]
+    return max(data.count(b"\n") - 1, 0)
+
+
+SWEEP_FILENAME_PATTERN = re.compile(
+    r"(?P<date>\d{2}-\d{2}-\d{4})_(?P<time>\d{2}-\d{2})_"
+    r"(?P<kind>laser_sweep|adaptive_sweep|resonance_finding|continuous_sweep)_samples_(?P<averages>\d+)_"
+    r"sensitivity_(?P<sensitivity>\d+)_(?P<laser>[A-Za-z]+)_(?P<rest>.*)")
+
+
+def parse_sweep_filename(filename: str):
+    """ Return the metadata stored in the name of a file saved by the sweeps (see perform_wavelength_sweep for the
+    naming format), or None if the name isn't in that format """
+    match = SWEEP_FILENAME_PATTERN.fullmatch(Path(filename).stem)
+    if match is None:
+        return None
+
+    metadata = {"kind": match["kind"], "laser": match["laser"], "averages": int(match["averages"]),
+                "sensitivity": int(match["sensitivity"]),
+                "timestamp": datetime.datetime.strptime(f"{match['date']}_{match['time']}", "%d-%m-%Y_%H-%M")
+                .isoformat()}
+    rest = match["rest"].split("_")
+    n_numbers = 1 if match["kind"] == "resonance_finding" else 3
+    numbers, label = rest[:n_numbers], "_".join(rest[n_numbers:])
+    if match["kind"] == "resonance_finding":
+        metadata["resonances"] = int(numbers[0])
+    else:
+        metadata["start"], metadata["stop"] = float(numbers[0]), float(numbers[1])
+        if match["kind"] in ("laser_sweep", "adaptive_sweep"):
+            metadata["steps"] = int(numbers[2])
+        else:
+            metadata["speed"] = float(numbers[2])
+    metadata["label"] = label
+    return metadata
+
+
+def load_sweep_rows(path):
+    """ Read the rows of (wavelength, reading_0, ..., reading_n) of a text or .npy sweep file into an array """
+    path = Path(path)
+    if path.suffix == ".npy":
+        return np.load(path)
+    with open(path) as f:
+        f.readline()
+        if not f.readline():
+            # Only the header, which np.loadtxt would warn about
+            return np.empty((0, 0))
+    return np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+
+
+def convert_sweep_file(path):
+    """ Convert a text sweep file into the binary .npy/.json format alongside it. Returns the path to the .npy file """
+    path = Path(path)
+    data = np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+    metadata = parse_sweep_filename(path.name) or {}
+    if len(data):
+        metadata.update({"start": float(data[0, 0]), "stop": float(data[-1, 0]), "reps": data.shape[1] - 1})
+        if len(data) > 1:
+            metadata["res"] = float(np.median(np.diff(data[:, 0])))
+
+    npy_path = path.with_suffix(".npy")
+    with open(npy_path, "wb") as file, BinarySweepWriter(file, data.shape[1] - 1, metadata,
+                                                         block_size=max(len(data), 1)) as writer:
+        for row in data:
+            writer.append(row[0], row[1:])
+    return npy_path
 
 
 class MockInstrument:
@@ -100,3 +325,6 @@ class MockInstrument:
 
     def read(self):
         return self.power
+
+    def read_burst(self, count: int):
+        return [self.power] * count
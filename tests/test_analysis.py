@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from core.analysis import ResonanceDetector, decimate_minmax, get_minima
+from core.simulation import RingResonator
+
+
+def detect_in_chunks(power_readings, wavelengths, width, thr, rng):
+    detector = ResonanceDetector(width=width, thr=thr)
+    found = []
+    start = 0
+    while start < len(wavelengths):
+        end = start + int(rng.integers(1, 3 * width + 2))
+        found += detector.update(wavelengths[start:end], power_readings[:, start:end])
+        start = end
+    found += detector.finish()
+    return detector, found
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_detector_matches_get_minima_on_noise(seed):
+    # Noise with a low threshold gives long chains of close minima, each able to suppress the next
+    rng = np.random.default_rng(seed)
+    width = int(rng.integers(1, 30))
+    thr = float(rng.uniform(0, 0.5))
+    wavelengths = np.linspace(1540, 1560, int(rng.integers(50, 2000)))
+    power_readings = rng.normal(-10, 0.3, (int(rng.integers(1, 4)), len(wavelengths)))
+
+    detector, found = detect_in_chunks(power_readings, wavelengths, width, thr, rng)
+    minima, resonances = get_minima(power_readings, wavelengths, width=width, thr=thr, verbose=False)
+
+    assert detector.minima == list(minima)
+    assert np.array_equal(found, resonances)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_detector_matches_get_minima_on_ring(seed):
+    rng = np.random.default_rng(seed)
+    width = int(rng.integers(2, 40))
+    thr = float(rng.uniform(0, 2))
+    wavelengths = np.arange(1540, 1560, 0.005)
+    transmission = RingResonator(length=float(rng.uniform(100, 400))).transmission_db(wavelengths) - 10
+    power_readings = transmission + rng.normal(0, 0.05, (2, len(wavelengths)))
+
+    detector, found = detect_in_chunks(power_readings, wavelengths, width, thr, rng)
+    minima, resonances = get_minima(power_readings, wavelengths, width=width, thr=thr, verbose=False)
+
+    assert detector.minima == list(minima)
+    assert np.array_equal(found, resonances)
+
+
+def test_decimate_minmax_skips_bins_of_nan():
+    rng = np.random.default_rng(0)
+    x = np.arange(100000, dtype=float)
+    y = rng.normal(size=len(x))
+    # A run of skipped points, saved as NaN rows, longer than a bin
+    y[50000:50100] = np.nan
+    y[12345] = -10
+
+    decimated_x, decimated_y = decimate_minmax(x, y, 1000)
+
+    assert len(decimated_x) <= 2000
+    assert not np.isnan(decimated_y).any()
+    assert 12345 in decimated_x
+    assert np.array_equal(decimate_minmax(x, np.full(len(x), np.nan), 1000)[1], [])